@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+"""
+    Profile the report queries against a local, synthetic copy of the
+    ordering schema
+
+    --load builds ordering_order, ordering_scene, auth_user and
+    ordering_configuration in the database of the configuration section
+    (benchdb by default, never the production section) and fills them
+    with generated orders and product_opts.  Each report query of
+    lsrd_stats and graphics is then run under
+    EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) and the timings reported.
+
+    Example:
+        python bench_db.py --load --orders 2000000
+        python bench_db.py --setup try_index.sql --output after.json
+"""
+import sys
+import json
+import time
+import argparse
+import datetime
+
+import utils
+import graphics
+import lsrd_stats
+from dbconnect import DBConnect, DBConnectException
+
+DATE_FMT = '%Y-%m-%d'
+
+# Marks a database as holding generated fixtures, nothing is dropped without it
+FIXTURE_TABLE = 'bench_fixture'
+
+SCHEMA_SQL = '''
+    create table auth_user (
+        id serial primary key,
+        username varchar(150) not null unique,
+        email varchar(254) not null,
+        date_joined timestamp with time zone not null default now());
+
+    create table ordering_configuration (
+        id serial primary key,
+        key varchar(255) not null unique,
+        value varchar(2048) not null);
+
+    create table ordering_order (
+        id serial primary key,
+        orderid varchar(255) not null unique,
+        user_id integer not null references auth_user (id),
+        order_type varchar(50) not null,
+        order_date timestamp with time zone not null,
+        completion_date timestamp with time zone,
+        status varchar(20) not null,
+        email varchar(256) not null,
+        order_source varchar(10) not null,
+        priority varchar(10),
+        note varchar(2048),
+        product_opts jsonb not null);
+    create index ordering_order_user_id on ordering_order (user_id);
+    create index ordering_order_order_date on ordering_order (order_date);
+    create index ordering_order_email on ordering_order (email);
+
+    create table ordering_scene (
+        id serial primary key,
+        name varchar(256) not null,
+        order_id integer not null references ordering_order (id),
+        sensor_type varchar(50) not null,
+        status varchar(30) not null,
+        download_size bigint);
+    create index ordering_scene_order_id on ordering_scene (order_id);
+    create index ordering_scene_name on ordering_scene (name);
+    create index ordering_scene_status on ordering_scene (status);
+
+    create table bench_fixture (
+        seed double precision,
+        orders integer,
+        created timestamp with time zone default now());
+'''
+
+# Input name of a random scene, as held in product_opts and ordering_scene.name
+# (n, the position in the order, keeps jsonb_agg of the names in the subquery)
+SCENE_FUNC_SQL = '''
+    create function pg_temp.bench_scene(prefix text, sensor text, n int) returns text as $$
+        select case
+            when sensor like 'm%' or sensor like 'v%' then
+                prefix || '.A' || to_char(d, 'YYYYDDD') || '.' || tile || '.'
+                || case when sensor like 'v%' then '001' else '006' end || '.2017012345678'
+            when sensor like '%_collection' then
+                prefix || '_L1TP_' || pathrow || '_' || to_char(d, 'YYYYMMDD') || '_20170304_01_T1'
+            else
+                prefix || pathrow || to_char(d, 'YYYYDDD') || 'LGN00'
+            end
+        from (select date '1984-03-01' + (random() * 12000)::int d,
+                     lpad((1 + floor(random() * 233))::text, 3, '0') ||
+                     lpad((1 + floor(random() * 248))::text, 3, '0') pathrow,
+                     'h' || lpad(floor(random() * 36)::text, 2, '0') ||
+                     'v' || lpad(floor(random() * 18)::text, 2, '0') tile) r
+    $$ language sql volatile;
+'''
+
+# Per order parameters, skewed so a few users place most of the orders
+# and most orders are small
+PARAMS_SQL = '''
+    create temp table bench_orders as
+    select i id,
+           1 + floor(power(random(), 3) * %(users)s)::int user_id,
+           %(begin)s::timestamp + random() * (%(stop)s::timestamp - %(begin)s::timestamp) order_date,
+           (%(sensors)s::text[])[1 + floor(random() * %(n_sensors)s)::int] sensor,
+           1 + floor(power(random(), 4) * %(max_scenes)s)::int n_scenes,
+           1 + floor(random() * 127)::int products,
+           random() < %(ee_share)s from_ee,
+           random() < 0.05 plot_statistics,
+           random() < 0.1 customized
+    from generate_series(1, %(orders)s) i ;
+'''
+
+USERS_SQL = '''
+    insert into auth_user (id, username, email)
+    select i, 'user' || i,
+           case when i %% 20 = 0 then 'user' || i || '@usgs.gov'
+                else 'user' || i || '@example.com' end
+    from generate_series(1, %(users)s) i ;
+'''
+
+ORDERS_SQL = '''
+    insert into ordering_order (id, orderid, user_id, order_type, order_date,
+                                completion_date, status, email, order_source,
+                                product_opts)
+    select o.id,
+           u.email || '-' || to_char(o.order_date, 'MMDDYYYY-HH24MISS') || '-' || o.id,
+           o.user_id, 'level2_ondemand', o.order_date,
+           o.order_date + interval '2 days', 'complete', u.email,
+           case when o.from_ee then 'ee' else 'espa' end,
+           jsonb_build_object(
+               o.sensor, jsonb_build_object(
+                   'inputs', (select jsonb_agg(pg_temp.bench_scene(%(prefixes)s::jsonb ->> o.sensor,
+                                                                   o.sensor, n))
+                              from generate_series(1, o.n_scenes) n),
+                   'products', (select jsonb_agg(p)
+                                from unnest(%(products)s::text[]) with ordinality t(p, n)
+                                where o.products & (1 << (n::int - 1)) > 0)),
+               'format', 'gtiff',
+               'plot_statistics', o.plot_statistics,
+               'note', '')
+           || case when o.customized
+                   then '{"projection": {"lonlat": null}, "resize": {"pixel_size": 30}}'::jsonb
+                   else '{}'::jsonb end
+    from bench_orders o
+    join auth_user u on u.id = o.user_id ;
+'''
+
+SCENES_SQL = '''
+    insert into ordering_scene (name, order_id, sensor_type, status, download_size)
+    select x.name, o.id,
+           case when j.sensor like 'm%%' then 'modis'
+                when j.sensor like 'v%%' then 'viirs'
+                else 'landsat' end,
+           'complete', (random() * 2e9)::bigint
+    from ordering_order o
+    cross join lateral jsonb_each(o.product_opts) j(sensor, opts)
+    cross join lateral jsonb_array_elements_text(j.opts->'inputs') x(name)
+    where jsonb_typeof(j.opts) = 'object'
+    and j.opts ? 'inputs' ;
+'''
+
+CONFIG_SQL = '''
+    insert into ordering_configuration (key, value) values
+        ('email.stats_notification', 'stats@example.com'),
+        ('email.stats_debug', 'debug@example.com'),
+        ('email.espa_address', 'espa@example.com'),
+        ('url.dev.weblogs', 'localhost:/tmp/logs') ;
+'''
+
+PRODUCTS = ('l1', 'sr', 'toa', 'bt', 'cloud', 'sr_ndvi', 'stats')
+
+
+def arg_parser(defaults):
+    """
+    Process the command line arguments
+    """
+    parser = argparse.ArgumentParser(description='Report query benchmarks')
+    parser.add_argument('-c', '--conf_file', dest='conf_file',
+                        default=defaults['conf_file'],
+                        help='Configuration file [%s]' % defaults['conf_file'])
+    parser.add_argument('--section', dest='section', default=defaults['section'],
+                        help='Configuration section of the fixture database [%s]'
+                        % defaults['section'])
+    parser.add_argument('--load', dest='load', action='store_true',
+                        help='(Re)build and fill the fixture tables first')
+    parser.add_argument('--orders', dest='orders', type=int, default=defaults['orders'],
+                        help='Orders to generate [%s]' % defaults['orders'])
+    parser.add_argument('--users', dest='users', type=int, default=defaults['users'],
+                        help='Users to generate [%s]' % defaults['users'])
+    parser.add_argument('--max_scenes', dest='max_scenes', type=int,
+                        default=defaults['max_scenes'],
+                        help='Largest number of scenes in an order [%s]'
+                        % defaults['max_scenes'])
+    parser.add_argument('--seed', dest='seed', type=float, default=defaults['seed'],
+                        help='Postgres random seed, between -1 and 1 [%s]'
+                        % defaults['seed'])
+    parser.add_argument('-b', '--begin', dest='begin', default=defaults['begin'],
+                        help='Start of the report window [%s]' % defaults['begin'])
+    parser.add_argument('-s', '--stop', dest='stop', default=defaults['stop'],
+                        help='End of the report window [%s]' % defaults['stop'])
+    parser.add_argument('--setup', dest='setup',
+                        help='SQL file to run before the queries (indexes to try, ...)')
+    parser.add_argument('--queries', dest='queries', nargs='+',
+                        help='Only explain these queries')
+    parser.add_argument('--runs', dest='runs', type=int, default=defaults['runs'],
+                        help='Runs of each query, the fastest is kept [%s]'
+                        % defaults['runs'])
+    parser.add_argument('--plans', dest='plans', action='store_true',
+                        help='Keep the full plans in the output')
+    parser.add_argument('-o', '--output', dest='output',
+                        help='Write the results as JSON to this file')
+
+    args = parser.parse_args()
+    defaults.update(args.__dict__)
+    return defaults
+
+
+def sensor_prefixes():
+    """
+    :return: {sensor key: product prefix of its input names}
+    """
+    prefixes = {}
+    for prefix, sensor in lsrd_stats.SENSOR_PREFIXES.items():
+        if sensor in lsrd_stats.SENSOR_KEYS:
+            prefixes[sensor] = prefix
+    return prefixes
+
+
+def load_fixtures(dbinfo, orders, users, max_scenes, seed):
+    """
+    Drop and rebuild the fixture tables, then fill them
+
+    :param dbinfo: connection information of the fixture database
+    :type dbinfo: dict
+    :param orders: number of orders
+    :param users: number of users
+    :param max_scenes: largest number of scenes in an order
+    :param seed: postgres random seed
+    """
+    prefixes = sensor_prefixes()
+    # Mostly Landsat collection orders, as in production
+    sensors = sorted(prefixes) + [s for s in sorted(prefixes) if s.endswith('_collection')] * 4
+    first = datetime.date.today().replace(day=1) - datetime.timedelta(days=730)
+    params = {'orders': orders, 'users': users, 'max_scenes': max_scenes,
+              'sensors': sensors, 'n_sensors': len(sensors),
+              'prefixes': json.dumps(prefixes), 'products': list(PRODUCTS),
+              'begin': first.strftime(DATE_FMT),
+              'stop': datetime.date.today().strftime(DATE_FMT),
+              'ee_share': 0.6}
+
+    with DBConnect(**dbinfo) as db:
+        db.select("select to_regclass('ordering_order'), to_regclass(%s)", (FIXTURE_TABLE, ))
+        existing, fixture = db[0]
+        if existing and not fixture:
+            raise RuntimeError('ordering_order exists but holds no generated fixtures, '
+                               'refusing to drop it')
+
+        db.execute('drop table if exists ordering_scene, ordering_order, auth_user, '
+                   'ordering_configuration, {} cascade'.format(FIXTURE_TABLE))
+        db.execute(SCHEMA_SQL)
+        db.execute(SCENE_FUNC_SQL)
+        db.execute('select setseed(%s)', (seed, ))
+
+        for name, sql in (('params', PARAMS_SQL), ('users', USERS_SQL),
+                          ('orders', ORDERS_SQL), ('scenes', SCENES_SQL),
+                          ('config', CONFIG_SQL)):
+            start = time.time()
+            db.execute(sql, params)
+            print('* Loaded {:<7} {:>10} rows in {:.1f}s'
+                  .format(name, db.cursor.rowcount, time.time() - start))
+
+        for table in ('auth_user', 'ordering_order', 'ordering_scene'):
+            db.execute("select setval(pg_get_serial_sequence('{0}', 'id'), "
+                       "(select max(id) from {0}))".format(table))
+        db.execute('insert into {} (seed, orders) values (%s, %s)'.format(FIXTURE_TABLE),
+                   (seed, orders))
+        db.execute('analyze')
+        db.commit()
+
+
+def report_queries(dbinfo, begin, stop):
+    """
+    The report queries, with the parameters a report run gives them
+
+    :param dbinfo: connection information
+    :type dbinfo: dict
+    :param begin: start of the report window, 'YYYY-MM-DD'
+    :param stop: end of the report window, 'YYYY-MM-DD'
+    :return: list of (name, sql, params)
+    """
+    sensors = tuple(k for k in lsrd_stats.SENSOR_KEYS if k != 'invalid')
+
+    # db_dl_prodinfo looks up the orders downloaded from in the window
+    with DBConnect(**dbinfo) as db:
+        db.select('select orderid from ordering_order '
+                  'where order_date::date >= %s and order_date::date <= %s '
+                  'order by id limit 5000', (begin, stop))
+        orderids = [row[0] for row in db]
+        db.select('select email from ordering_order order by user_id limit 1')
+        email = db[0][0] if len(db) else ''
+
+    return [
+        ('db_ondemand_stats', lsrd_stats.ONDEMAND_SQL,
+         (begin, stop, lsrd_stats.ORDER_SOURCES, sensors)),
+        ('db_top10stats', lsrd_stats.TOP10_SQL, (begin, stop, sensors)),
+        ('db_prodinfo', lsrd_stats.PRODINFO_SQL, (begin, stop, sensors)),
+        ('db_prodinfo_python', lsrd_stats.PRODOPTS_SQL, (begin, stop, sensors)),
+        ('db_dl_prodinfo', lsrd_stats.DL_PRODINFO_SQL, (orderids, )),
+        ('query_scene_count', graphics.SCENE_COUNT_SQL.format(begin, stop, ''), None),
+        ('query_scene_count_user', graphics.SCENE_COUNT_SQL
+         .format(begin, stop, "and o.email = '%s'" % email), None),
+        ('query_sensor_count', graphics.SENSOR_COUNT_SQL.format(begin, stop), None),
+    ]
+
+
+def explain(db, sql, params=None):
+    """
+    Run a query under EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON)
+
+    :param db: open connection
+    :type db: DBConnect
+    :return: dict of the timings and buffer counts, and the plan
+    """
+    db.select('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + sql, params)
+    plan = db[0][0]
+    if isinstance(plan, basestring):
+        plan = json.loads(plan)
+    plan = plan[0]
+    top = plan['Plan']
+
+    return {'execution_ms': plan['Execution Time'],
+            'planning_ms': plan['Planning Time'],
+            'rows': top['Actual Rows'],
+            'shared_hit_blocks': top.get('Shared Hit Blocks', 0),
+            'shared_read_blocks': top.get('Shared Read Blocks', 0),
+            'temp_blocks': (top.get('Temp Read Blocks', 0) +
+                            top.get('Temp Written Blocks', 0)),
+            'plan': plan}
+
+
+def run():
+    rng = lsrd_stats.date_range()
+    defaults = {'conf_file': utils.CONF_FILE,
+                'section': 'benchdb',
+                'orders': 1000000,
+                'users': 20000,
+                'max_scenes': 500,
+                'seed': 0.42,
+                'begin': rng[0].strftime(DATE_FMT),
+                'stop': rng[1].strftime(DATE_FMT),
+                'runs': 3}
+    opts = arg_parser(defaults)
+    dbinfo = utils.get_cfg(opts['conf_file'], section=opts['section'])
+
+    if opts['load']:
+        start = time.time()
+        load_fixtures(dbinfo, opts['orders'], opts['users'], opts['max_scenes'],
+                      opts['seed'])
+        print('* Fixtures loaded in {:.1f}s'.format(time.time() - start))
+
+    queries = report_queries(dbinfo, opts['begin'], opts['stop'])
+    if opts['queries']:
+        queries = [q for q in queries if q[0] in opts['queries']]
+
+    results = {'timestamp': datetime.datetime.now().isoformat(),
+               'begin': opts['begin'],
+               'stop': opts['stop'],
+               'queries': {}}
+
+    with DBConnect(**dbinfo) as db:
+        db.select('select version()')
+        results['server'] = db[0][0]
+        db.select('select seed, orders from {}'.format(FIXTURE_TABLE))
+        results['fixture'] = dict(zip(('seed', 'orders'), db[0])) if len(db) else None
+
+        if opts['setup']:
+            with open(opts['setup']) as fid:
+                db.execute(fid.read())
+
+        for name, sql, params in queries:
+            try:
+                runs = [explain(db, sql, params) for _ in range(opts['runs'])]
+            except DBConnectException as e:
+                print('! {}: {}'.format(name, e))
+                db.rollback()
+                continue
+
+            best = min(runs, key=lambda r: r['execution_ms'])
+            if not opts['plans']:
+                del best['plan']
+            best['runs_ms'] = [round(r['execution_ms'], 3) for r in runs]
+            results['queries'][name] = best
+            print('{:<24} {:>10.1f} ms {:>8.1f} ms plan {:>10} rows {:>10} hit {:>10} read'
+                  .format(name, best['execution_ms'], best['planning_ms'], best['rows'],
+                          best['shared_hit_blocks'], best['shared_read_blocks']))
+
+        # Nothing tried through --setup is kept
+        db.rollback()
+
+    if opts['output']:
+        with open(opts['output'], 'w') as fid:
+            json.dump(results, fid, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+
+    return results
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,375 @@
+#!/usr/bin/env python
+"""
+    Benchmarks for the web log metrics, run against synthetic access logs
+
+    Writes gzipped logs in every nginx format of weblogs.REGEXES, with
+    Landsat/MODIS/VIIRS order downloads and the product options of those
+    orders, then times each stage of the download metrics.  The logs are
+    generated from a fixed seed, so results can be compared across commits.
+
+    Example:
+        python bench_logs.py --days 3 --lines 200000 --output bench.json
+"""
+import os
+import sys
+import json
+import time
+import gzip
+import random
+import shutil
+import argparse
+import datetime
+import resource
+import tempfile
+import subprocess
+import multiprocessing as mp
+
+import weblogs
+import lsrd_stats
+
+DATE_FMT = '%Y-%m-%d'
+LOG_TS_FMT = '%d/%b/%Y:%H:%M:%S -0500'
+LOG_NAME = 'bench_edclpdsftp.cr.usgs.gov-ssl-access_log-{:%Y%m%d}.gz'
+
+# One template per pattern of weblogs.REGEXES, in the same order.  Each
+# is only parsed by its own pattern, the last one needs a remote user
+LOG_FORMATS = (
+    '{ip} - [{ts}] "GET {res} HTTP/1.1" {status} {size} - {size} [{rtime:.3f}] "-" "{agent}"\n',
+    '{ip} - - [{ts}] "GET {res} {status}" {size} 0 "{agent}" "-"\n',
+    '{ip} - - [{ts}] "GET {res} HTTP/1.1" {status} {size} "-" "{agent}"\n',
+    '{ip} - espa [{ts}] "GET {res} HTTP/1.1" {status} {size} bytes=0- {size} [{rtime:.3f}] '
+    '"-" "{agent}"\n',
+)
+
+AGENTS = ('Wget/1.14 (linux-gnu)', 'curl/7.29.0', 'python-requests/2.18.4',
+          'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36')
+NOISE = ('/index.html', '/static/espa.css', '/orders/', '/robots.txt')
+# Share of the download lines which are not a 200
+STATUS_WEIGHTS = (('200', 0.85), ('206', 0.10), ('404', 0.05))
+
+LANDSAT_PRE = ('LT4', 'LT5', 'LE7', 'LC8')
+LANDSAT_COLLECT = ('LT04', 'LT05', 'LE07', 'LC08')
+MODIS = ('MOD09A1', 'MOD09GA', 'MOD09GQ', 'MOD13A1', 'MYD09A1', 'MYD13Q1')
+VIIRS = ('VNP09GA', )
+PRODUCTS = ('l1', 'sr', 'toa', 'bt', 'cloud', 'sr_ndvi', 'stats')
+
+STAGES = ('read', 'match', 'calc_dlinfo', 'get_sensor_name', 'tally_product_dls')
+
+
+def arg_parser(defaults):
+    """
+    Process the command line arguments
+    """
+    parser = argparse.ArgumentParser(description='Web log metrics benchmarks')
+    parser.add_argument('-d', '--dir', dest='dir', default=defaults['dir'],
+                        help='Directory for the synthetic logs [temporary]')
+    parser.add_argument('--days', dest='days', type=int, default=defaults['days'],
+                        help='Number of daily logs [%s]' % defaults['days'])
+    parser.add_argument('--lines', dest='lines', type=int, default=defaults['lines'],
+                        help='Lines per daily log [%s]' % defaults['lines'])
+    parser.add_argument('--orders', dest='orders', type=int, default=defaults['orders'],
+                        help='Number of orders downloaded from [%s]' % defaults['orders'])
+    parser.add_argument('--format', dest='format', type=int, default=defaults['format'],
+                        choices=range(len(LOG_FORMATS)),
+                        help='Write every log in this format of weblogs.REGEXES '
+                             '[rotate through all]')
+    parser.add_argument('--seed', dest='seed', type=int, default=defaults['seed'],
+                        help='Random seed [%s]' % defaults['seed'])
+    parser.add_argument('--reader', dest='reader', choices=weblogs.READERS,
+                        default=defaults['reader'],
+                        help='How to decompress the logs [%s]' % defaults['reader'])
+    parser.add_argument('-w', '--workers', dest='workers', type=int,
+                        default=defaults['workers'],
+                        help='Processes used by calc_dlinfo [%s]' % defaults['workers'])
+    parser.add_argument('--repeat', dest='repeat', type=int, default=defaults['repeat'],
+                        help='Runs of each stage, the fastest is kept [%s]'
+                        % defaults['repeat'])
+    parser.add_argument('--stages', dest='stages', nargs='+', choices=STAGES,
+                        default=defaults['stages'], help='Stages to run [all]')
+    parser.add_argument('-o', '--output', dest='output', default=defaults['output'],
+                        help='Write the results as JSON to this file')
+
+    args = parser.parse_args()
+    defaults.update(args.__dict__)
+    return defaults
+
+
+def make_order(rng, number):
+    """
+    Make up an order, with the download names of its scenes and its
+    product options as stored in ordering_order.product_opts
+
+    :param rng: random number generator
+    :type rng: random.Random
+    :param number: sequence number of the order, keeps the ids unique
+    :return: orderid, list of scene names, product options
+    """
+    email = rng.choice(('someone@usgs.gov', 'earthengine-landsat@google.com',
+                        'user{}@example.com'.format(rng.randint(1, 500))))
+    orderid = '{}-{:08d}-{:06d}'.format(email, number, rng.randint(0, 235959))
+    # Orders hold the scenes of a single product
+    family = rng.choice(('pre', 'collection', 'collection', 'modis', 'viirs'))
+    prefix = rng.choice({'pre': LANDSAT_PRE, 'collection': LANDSAT_COLLECT,
+                         'modis': MODIS, 'viirs': VIIRS}[family])
+    scenes, inputs = [], []
+
+    for _ in range(rng.randint(1, 20)):
+        year, doy = rng.randint(1984, 2018), rng.randint(1, 365)
+        if family == 'pre':
+            scene = '{}{:03d}{:03d}{}{:03d}'.format(prefix, rng.randint(1, 233),
+                                                    rng.randint(1, 248), year, doy)
+            inputs.append(scene + 'LGN00')
+        elif family == 'collection':
+            pathrow = '{:03d}{:03d}'.format(rng.randint(1, 233), rng.randint(1, 248))
+            acquired = (datetime.date(year, 1, 1) + datetime.timedelta(doy - 1)).strftime('%Y%m%d')
+            scene = '{}{}{}01T1'.format(prefix, pathrow, acquired)
+            inputs.append('{}_L1TP_{}_{}_20170304_01_T1'.format(prefix, pathrow, acquired))
+        else:
+            tile = 'h{:02d}v{:02d}'.format(rng.randint(0, 35), rng.randint(0, 17))
+            version = '006' if family == 'modis' else '001'
+            scene = '{}{}{}{:03d}{}'.format(prefix, tile, year, doy, version)
+            inputs.append('{}.A{}{:03d}.{}.{}.2017012345678'.format(prefix, year, doy,
+                                                                    tile, version))
+        scenes.append(scene)
+
+    opts = {lsrd_stats.get_sensor_name(scenes[0]): {
+                'inputs': inputs,
+                'products': rng.sample(PRODUCTS, rng.randint(1, 3))},
+            'plot_statistics': rng.random() < 0.1}
+    if rng.random() < 0.2:
+        opts['projection'] = {'lonlat': None}
+
+    return orderid, scenes, opts
+
+
+def make_orders(rng, count):
+    """
+    :param rng: random number generator
+    :param count: number of orders
+    :return: list of (orderid, scenes), {orderid: product options}
+    """
+    orders, prod_opts = [], {}
+    for number in range(count):
+        orderid, scenes, opts = make_order(rng, number)
+        orders.append((orderid, scenes))
+        prod_opts[orderid] = opts
+    return orders, prod_opts
+
+
+def write_logs(rng, directory, first_day, days, lines, orders, fmt=None):
+    """
+    Write a gzipped access log per day, a third of the lines being
+    requests other than order downloads
+
+    :param rng: random number generator
+    :param directory: where to write the logs
+    :param first_day: day of the first log
+    :type first_day: datetime.date
+    :param days: number of logs
+    :param lines: lines per log
+    :param orders: list of (orderid, scenes) to download from
+    :param fmt: index into LOG_FORMATS, otherwise rotate by day
+    :return: list of paths, total uncompressed bytes
+    """
+    statuses = [s for s, w in STATUS_WEIGHTS for _ in range(int(w * 100))]
+    paths, total = [], 0
+
+    for i in range(days):
+        day = first_day + datetime.timedelta(i)
+        template = LOG_FORMATS[fmt if fmt is not None else i % len(LOG_FORMATS)]
+        # Logs are rotated just after midnight, so they are named for the next day
+        path = os.path.join(directory, LOG_NAME.format(day + datetime.timedelta(1)))
+        midnight = datetime.datetime.combine(day, datetime.time())
+
+        out = gzip.GzipFile(path, 'wb', 6, mtime=0)
+        try:
+            for n in range(lines):
+                if rng.random() < 0.33:
+                    res, status, size = rng.choice(NOISE), '200', rng.randint(100, 50000)
+                else:
+                    orderid, scenes = rng.choice(orders)
+                    res = '/orders/{}/{}-SC{}.tar.gz'.format(
+                        orderid, rng.choice(scenes), day.strftime('%Y%m%d%H%M%S'))
+                    status, size = rng.choice(statuses), rng.randint(10 ** 6, 2 * 10 ** 9)
+                ts = midnight + datetime.timedelta(seconds=n * 86400 // lines)
+                line = template.format(ip='10.{}.{}.{}'.format(*rng.sample(range(256), 3)),
+                                       ts=ts.strftime(LOG_TS_FMT), res=res, status=status,
+                                       size=size, rtime=rng.random() * 60,
+                                       agent=rng.choice(AGENTS))
+                total += len(line)
+                out.write(line)
+        finally:
+            out.close()
+        paths.append(path)
+
+    return paths, total
+
+
+def git_revision():
+    """
+    :return: commit the benchmarks ran against, None outside of a checkout
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        rev = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=here,
+                                      stderr=subprocess.STDOUT).strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--', '.'],
+                                        cwd=here).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return rev + ('-dirty' if dirty else '')
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory of this process and its finished children
+    (ru_maxrss is in KB on Linux)
+    """
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024.0
+
+
+def stage_read(ctx):
+    lines = 0
+    for path in ctx['paths']:
+        for _ in weblogs.open_log(path, ctx['reader']):
+            lines += 1
+    return lines
+
+
+def stage_match(ctx):
+    lines = 0
+    for path in ctx['paths']:
+        matcher = weblogs.LogMatcher(ctx['begin'], ctx['stop'])
+        for line in weblogs.open_log(path, ctx['reader']):
+            matcher.match(line)
+            lines += 1
+    return lines
+
+
+def stage_calc_dlinfo(ctx):
+    lsrd_stats.calc_dlinfo(ctx['glob'], ctx['begin'], ctx['stop'], ctx['sensors'],
+                           ctx['workers'], False, ctx['reader'])
+    return ctx['lines']
+
+
+def stage_get_sensor_name(ctx):
+    for res in ctx['resources']:
+        lsrd_stats.get_sensor_name(res)
+    return len(ctx['resources'])
+
+
+def stage_tally_product_dls(ctx):
+    lsrd_stats.tally_product_dls(ctx['orders_scenes'], ctx['prod_opts'])
+    return len(ctx['orders_scenes'])
+
+
+def run_stage(name, ctx, queue):
+    """
+    Time one stage in a process of its own, so its peak memory is not
+    hidden by the stages before it
+    """
+    func = globals()['stage_' + name]
+    start = time.time()
+    items = func(ctx)
+    queue.put((items, time.time() - start, peak_rss_mb()))
+
+
+def bench_stage(name, ctx, repeat):
+    """
+    :return: dict of the stage results, from the fastest run
+    """
+    best = None
+    for _ in range(repeat):
+        queue = mp.Queue()
+        proc = mp.Process(target=run_stage, args=(name, ctx, queue))
+        proc.start()
+        items, seconds, rss = queue.get()
+        proc.join()
+        if best is None or seconds < best[1]:
+            best = items, seconds, rss
+
+    items, seconds, rss = best
+    result = {'items': items,
+              'seconds': round(seconds, 4),
+              'items_per_sec': round(items / max(seconds, 1e-9), 1),
+              'peak_rss_mb': round(rss, 1)}
+    if name in ('read', 'match', 'calc_dlinfo'):
+        result['mb_per_sec'] = round(ctx['bytes'] / 1048576.0 / max(seconds, 1e-9), 2)
+    return result
+
+
+def run():
+    defaults = {'dir': None,
+                'days': 3,
+                'lines': 100000,
+                'orders': 2000,
+                'format': None,
+                'seed': 42,
+                'reader': 'auto',
+                'workers': 1,
+                'repeat': 3,
+                'stages': list(STAGES),
+                'output': None}
+    opts = arg_parser(defaults)
+
+    rng = random.Random(opts['seed'])
+    directory = opts['dir'] or tempfile.mkdtemp(prefix='bench_logs_')
+    first_day = datetime.date(2019, 8, 1)
+    try:
+        start = time.time()
+        orders, prod_opts = make_orders(rng, opts['orders'])
+        paths, total = write_logs(rng, directory, first_day, opts['days'],
+                                  opts['lines'], orders, opts['format'])
+        print('* Generated {} logs, {:.1f} MB in {:.1f}s'
+              .format(len(paths), total / 1048576.0, time.time() - start))
+
+        begin, stop = first_day, first_day + datetime.timedelta(opts['days'] - 1)
+        resources = []
+        for path in paths:
+            matcher = weblogs.LogMatcher(begin, stop)
+            resources.extend(gr['resource'] for gr in
+                             (matcher.match(l) for l in weblogs.open_log(path)) if gr)
+
+        ctx = {'paths': paths,
+               'glob': os.path.join(directory, LOG_NAME.split('{')[0] + '*.gz'),
+               'begin': begin,
+               'stop': stop,
+               'sensors': tuple(k for k in lsrd_stats.SENSOR_KEYS if k != 'invalid'),
+               'reader': weblogs.find_reader(opts['reader']),
+               'workers': opts['workers'],
+               'lines': opts['days'] * opts['lines'],
+               'bytes': total,
+               'resources': resources,
+               'orders_scenes': lsrd_stats.extract_orderid(resources),
+               'prod_opts': prod_opts}
+
+        results = {'revision': git_revision(),
+                   'timestamp': datetime.datetime.now().isoformat(),
+                   'python': sys.version.split()[0],
+                   'params': {k: opts[k] for k in ('days', 'lines', 'orders', 'format',
+                                                   'seed', 'workers', 'repeat')},
+                   'reader': ctx['reader'],
+                   'uncompressed_mb': round(total / 1048576.0, 2),
+                   'stages': {}}
+
+        for name in opts['stages']:
+            results['stages'][name] = res = bench_stage(name, ctx, opts['repeat'])
+            print('{:<18} {:>10.3f}s {:>12.0f}/s {:>9} MB/s {:>8.1f} MB peak'
+                  .format(name, res['seconds'], res['items_per_sec'],
+                          res.get('mb_per_sec', '-'), res['peak_rss_mb']))
+    finally:
+        if not opts['dir']:
+            shutil.rmtree(directory)
+
+    if opts['output']:
+        with open(opts['output'], 'w') as fid:
+            json.dump(results, fid, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+    return results
+
+
+if __name__ == '__main__':
+    run()
@@ -3,28 +3,137 @@
 import psycopg2
 import psycopg2.extras
 import psycopg2.extensions
+import psycopg2.pool
 import numbers
+import itertools
+import threading
+from contextlib import contextmanager
+
+import profiling
+
+
+# Open connection pools, keyed on (host, database, user, port)
+_pools = {}
+_pools_lock = threading.Lock()
+
+# Rows fetched per round trip by DBConnect.stream
+ITERSIZE = 2000
+_cursor_ids = itertools.count()
 
 
 class DBConnectException(Exception):
     pass
 
+
+def pool_key(dbhost='localhost', db='postgres', dbuser='postgres', dbport=5432,
+             *args, **kwargs):
+    return dbhost, db, dbuser, int(dbport)
+
+
+@contextmanager
+def connection_pool(dbhost='localhost', db='postgres', dbuser='postgres', dbpass='postgres',
+                    dbport=5432, minconn=1, maxconn=4, *args, **kwargs):
+    """
+    Share connections to a database for the duration of a with statement
+
+    While the pool is open, every DBConnect to the same database borrows
+    an already established connection rather than opening its own, and
+    hands it back when done.  Sequential use keeps reusing a single
+    connection.  Nested pools for the same database reuse the outer one.
+
+    with connection_pool(**dbinfo):
+        with DBConnect(**dbinfo) as db:
+            ...
+    """
+    key = pool_key(dbhost, db, dbuser, dbport)
+    with _pools_lock:
+        pool = _pools.get(key)
+        owner = pool is None
+        if owner:
+            try:
+                pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, host=dbhost,
+                                                            database=db, user=dbuser,
+                                                            password=dbpass, port=dbport)
+            except psycopg2.Error as e:
+                raise DBConnectException(e)
+            _pools[key] = pool
+
+    try:
+        yield pool
+    finally:
+        if owner:
+            with _pools_lock:
+                # may have been replaced by refresh_pool meanwhile
+                pool = _pools.pop(key)
+            pool.closeall()
+
+
+def refresh_pool(dbhost='localhost', db='postgres', dbuser='postgres', dbpass='postgres',
+                 dbport=5432, *args, **kwargs):
+    """
+    Close every connection of the open pool of a database, e.g. before
+    forking worker processes which must not inherit them.  The with
+    statement of the pool carries on with an empty one, which connects
+    again when next borrowed from.  Nothing is done if no pool is open
+    """
+    key = pool_key(dbhost, db, dbuser, dbport)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            return
+        # created without connecting, minconn still sets how many are kept
+        fresh = psycopg2.pool.ThreadedConnectionPool(0, pool.maxconn, host=dbhost,
+                                                     database=db, user=dbuser,
+                                                     password=dbpass, port=dbport)
+        fresh.minconn = pool.minconn
+        _pools[key] = fresh
+    pool.closeall()
+
+
 class DBConnect(object):
     """
     Class for connecting to a postgresql database using a single with statement
+    Connections come from the matching connection_pool if one is open
     """
     def __init__(self, dbhost='localhost', db='postgres', dbuser='postgres', dbpass='postgres',
                  dbport=5432, autocommit=False, cursor_factory=None, *args, **kwargs):
+        self.conn, self.cursor = None, None
+        self.pool = _pools.get(pool_key(dbhost, db, dbuser, dbport))
         try:
-            self.conn = psycopg2.connect(host=dbhost, database=db, user=dbuser,
-                                         password=dbpass, port=dbport)
+            if self.pool is not None:
+                self.conn = self.borrow(self.pool)
+            else:
+                self.conn = psycopg2.connect(host=dbhost, database=db, user=dbuser,
+                                             password=dbpass, port=dbport)
             self.cursor = self.conn.cursor(cursor_factory=cursor_factory)
         except psycopg2.Error as e:
+            self.close()
             raise DBConnectException(e)
 
         self.autocommit = autocommit
+        self.cursor_factory = cursor_factory
         self.fetcharr = []
 
+    @staticmethod
+    def borrow(pool, attempts=2):
+        """
+        Take a connection from the pool, checking it still works first
+        since the server may have dropped it while it sat idle.  Broken
+        connections are thrown away and replaced
+        """
+        for attempt in range(attempts):
+            conn = pool.getconn()
+            try:
+                cursor = conn.cursor()
+                cursor.execute('SELECT 1')
+                cursor.close()
+                conn.rollback()
+                return conn
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                pool.putconn(conn, close=True)
+                if attempt == attempts - 1:
+                    raise
+
     def execute(self, sql_str, params=None):
         """
         Used for enacting some change on a database
@@ -55,6 +164,42 @@ class DBConnect(object):
         except psycopg2.Error as e:
             raise DBConnectException(e)
 
+        profiling.count('db_queries')
+        profiling.count('db_rows', len(self.fetcharr))
+
+    def stream(self, sql_str, params=None, itersize=ITERSIZE):
+        """
+        Used for retrieving large results from the database
+        Rows are read through a server side (named) cursor, itersize at
+        a time, and yielded one by one so the full result is never held
+        in memory.  Nothing is stored in self.fetcharr
+        """
+        if params and not self.verify_type(params):
+            params = self.conv_totuple(params)
+
+        name = 'dbconnect_stream_{0}'.format(next(_cursor_ids))
+        try:
+            cursor = self.conn.cursor(name=name, cursor_factory=self.cursor_factory)
+            cursor.itersize = itersize
+            cursor.execute(sql_str, params)
+        except psycopg2.Error as e:
+            raise DBConnectException(e)
+
+        profiling.count('db_queries')
+        try:
+            while True:
+                try:
+                    rows = cursor.fetchmany(itersize)
+                except psycopg2.Error as e:
+                    raise DBConnectException(e)
+                if not rows:
+                    break
+                profiling.count('db_rows', len(rows))
+                for row in rows:
+                    yield row
+        finally:
+            cursor.close()
+
     def commit(self):
         try:
             self.conn.commit()
@@ -64,6 +209,22 @@ class DBConnect(object):
     def rollback(self):
         self.conn.rollback()
 
+    def close(self):
+        """
+        Close the cursor and the connection, or hand the connection
+        back to its pool (which rolls back any open transaction)
+        """
+        cursor, conn = self.cursor, self.conn
+        self.cursor, self.conn = None, None
+
+        if cursor is not None:
+            cursor.close()
+        if conn is not None:
+            if self.pool is not None and not self.pool.closed:
+                self.pool.putconn(conn)
+            else:
+                conn.close()
+
     @staticmethod
     def conv_totuple(val):
         """
@@ -95,8 +256,7 @@ class DBConnect(object):
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         try:
-            self.cursor.close()
-            self.conn.close()
+            self.close()
         except psycopg2.Error as e:
             raise DBConnectException(e)
 
@@ -114,10 +274,6 @@ class DBConnect(object):
 
     def __del__(self):
         try:
-            self.cursor.close()
-            self.conn.close()
-
-            del self.cursor
-            del self.conn
+            self.close()
         except Exception as e:
             raise DBConnectException(e)
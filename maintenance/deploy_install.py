@@ -1,8 +1,15 @@
 #!/usr/bin/env python
 
+import sys
+import time
+import select
 import paramiko
 import argparse
 import datetime
+import threading
+import traceback
+from collections import deque, OrderedDict
+from multiprocessing.pool import ThreadPool
 
 try:
     import deployment_settings as settings
@@ -56,18 +63,99 @@ environments = {
     raise e
 
 
+class DeploymentError(Exception):
+    ''' Raised once all concurrent deployments are done, when any failed '''
+    pass
+
+
+class BarrierAborted(Exception):
+    ''' Raised to deployments waiting at a barrier another one will never
+    reach '''
+    pass
+
+
+class Barrier(object):
+    ''' Blocks each of a fixed number of threads in wait() until all have
+    called it.  abort() releases the waiting threads with BarrierAborted,
+    e.g. when one of them failed before getting there '''
+
+    def __init__(self, parties):
+        self.parties = parties
+        self.arrived = 0
+        # once released, a later abort no longer concerns the waiters
+        self.released = False
+        self.aborted = False
+        self.condition = threading.Condition()
+
+    def wait(self):
+        with self.condition:
+            self.arrived += 1
+            if self.arrived >= self.parties and not self.aborted:
+                self.released = True
+                self.condition.notify_all()
+            while not self.released and not self.aborted:
+                # a timeout keeps the wait interruptible with ctrl-c
+                self.condition.wait(1)
+            if not self.released:
+                raise BarrierAborted('Another deployment failed, not continuing')
+
+    def abort(self):
+        with self.condition:
+            self.aborted = True
+            self.condition.notify_all()
+
+
+class PrefixedOutput(object):
+    ''' Stands in for sys.stdout while deploying concurrently.  Complete lines
+    are written with the prefix of the thread which printed them, so the
+    output of each host stays readable '''
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def set_prefix(self, prefix):
+        self.local.prefix = prefix
+
+    def write(self, text):
+        pending = getattr(self.local, 'pending', '') + text
+        lines = pending.split('\n')
+        self.local.pending = lines.pop()
+        if lines:
+            prefix = getattr(self.local, 'prefix', '')
+            with self.lock:
+                self.stream.write(''.join('%s%s\n' % (prefix, line)
+                                          for line in lines))
+                self.stream.flush()
+
+    def flush(self):
+        pending = getattr(self.local, 'pending', '')
+        if pending:
+            self.write('\n')
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
 class RemoteHost(object):
     '''Duplicated from espa_common/sshcmd.py, included here for convienience
     Runs a command on a remote host.  If no password is supplied, assumes
-    you have passwordless ssh set up '''
+    you have passwordless ssh set up.  The connection is made on the first
+    command and kept open, each command runs in a channel of its own, until
+    close() is called '''
 
     client = None
+    # reads of 32KB from stdout or stderr per pass of stream()
+    reads_per_pass = 8
 
-    def __init__(self, host, user, pw=None, debug=False):
+    def __init__(self, host, user, pw=None, debug=False, keepalive=30):
         self.host = host
         self.user = user
         self.pw = pw
         self.debug = debug
+        # seconds between keepalive packets, so idle connections aren't dropped
+        self.keepalive = keepalive
 
     def __repr__(self):
         if self.pw:
@@ -80,57 +168,161 @@ class RemoteHost(object):
                                                             self.debug)
         return s
 
-    def execute(self, command, expected_exit_status=0):
-        try:
-            if self.debug is True:
-                print("Attempting to run [%s] on %s as %s" % (command,
-                                                              self.host,
-                                                              self.user))
+    def __enter__(self):
+        return self
 
-            self.client = paramiko.SSHClient()
-            self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
-            if self.pw is not None:
-                self.client.connect(self.host,
-                                    username=self.user,
-                                    password=self.pw)
-            else:
-                self.client.connect(self.host, username=self.user)
+    def connect(self):
+        ''' Opens the connection, unless the current one is still up '''
+        if self.client is not None:
+            transport = self.client.get_transport()
+            if transport is not None and transport.is_active():
+                return
+            self.close()
 
-            stdin, stdout, stderr = self.client.exec_command(command)
-            stdin.close()
+        if self.debug is True:
+            print("Connecting to %s as %s" % (self.host, self.user))
 
-            result = {'stdout': stdout.readlines(),
-                      'stderr': stderr.readlines(),
-                      'exit_status': stdout.channel.recv_exit_status()}
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
 
-            if result['exit_status'] is not expected_exit_status:
-                msg = "Error running %s." % command
-                msg = "\n".join([msg, "Error:%s" % result['stderr']])
-                msg = "\n".join([msg,
-                                 "Exit status:%s" % result['exit_status']])
-                raise Exception(msg)
-            else:
-                if self.debug is True:
-                    out = 'None'
-                    if ('stdout' in result and
-                        result['stdout'] is not None and
-                        len(result['stdout']) is not 0):
-                        out = result['stdout']
+        if self.pw is not None:
+            client.connect(self.host,
+                           username=self.user,
+                           password=self.pw)
+        else:
+            client.connect(self.host, username=self.user)
+
+        if self.keepalive:
+            client.get_transport().set_keepalive(self.keepalive)
 
-                    print("stdout:%s" % out)
+        self.client = client
 
-                return result
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+            self.client = None
 
+    def open_command(self, command):
+        ''' Starts command in a new channel, reconnecting once if the
+        connection dropped since the previous command '''
+        self.connect()
+        try:
+            return self.client.exec_command(command)
+        except (paramiko.SSHException, EOFError, IOError), e:
+            # the command never started, so it is safe to run it again
+            if self.debug is True:
+                print("Reconnecting to %s: %s" % (self.host, e))
+            self.close()
+            self.connect()
+            return self.client.exec_command(command)
+
+    def stream(self, channel, callback=None, timeout=None, tail=100):
+        ''' Reads the output of a running command as it arrives, passing
+        each line to callback(line, name), name being 'stdout' or 'stderr'.
+        Only the last tail lines of each are kept for the result.  Raises
+        an Exception if the command runs for more than timeout seconds, the
+        channel is closed then but the remote process may keep running '''
+        lines = {'stdout': deque(maxlen=tail), 'stderr': deque(maxlen=tail)}
+        pending = {'stdout': '', 'stderr': ''}
+        reads = (('stdout', channel.recv_ready, channel.recv),
+                 ('stderr', channel.recv_stderr_ready, channel.recv_stderr))
+        started = time.time()
+
+        def emit(name, data, final=False):
+            text = pending[name] + data
+            parts = text.split('\n')
+            pending[name] = '' if final else parts.pop()
+            for line in parts:
+                if final and not line:
+                    continue
+                line = line.rstrip('\r') + '\n'
+                lines[name].append(line)
+                if callback is not None:
+                    callback(line, name)
+
+        channel.setblocking(0)
+        while True:
+            got = False
+            for name, ready, recv in reads:
+                # bounded, so a command which never stops writing can
+                # neither starve the other stream nor the timeout
+                for _ in range(self.reads_per_pass):
+                    if not ready():
+                        break
+                    data = recv(32768)
+                    if not data:
+                        break
+                    emit(name, data)
+                    got = True
+
+            if timeout is not None and time.time() - started > timeout:
+                channel.close()
+                raise Exception("Timed out after %ss running on %s, the command "
+                                "may still be running there, last output:\n%s"
+                                % (timeout, self.host,
+                                   ''.join(lines['stdout']) + ''.join(lines['stderr'])))
+
+            if not got:
+                if (channel.exit_status_ready() and not channel.recv_ready()
+                        and not channel.recv_stderr_ready()):
+                    break
+                select.select([channel], [], [], 0.5)
+
+        emit('stdout', '', final=True)
+        emit('stderr', '', final=True)
+        return {'stdout': list(lines['stdout']),
+                'stderr': list(lines['stderr']),
+                'exit_status': channel.recv_exit_status()}
+
+    def execute(self, command, expected_exit_status=0, stream=False,
+                callback=None, timeout=None, tail=100):
+        ''' Runs command and waits for it to finish.  With stream, the output
+        is handed line by line to callback as it comes, only the last tail
+        lines are returned, and timeout (seconds) is enforced '''
+        if self.debug is True:
+            print("Attempting to run [%s] on %s as %s" % (command,
+                                                          self.host,
+                                                          self.user))
+
+        stdin, stdout, stderr = self.open_command(command)
+        stdin.close()
+
+        try:
+            if stream is True:
+                result = self.stream(stdout.channel, callback, timeout, tail)
+            else:
+                result = {'stdout': stdout.readlines(),
+                          'stderr': stderr.readlines(),
+                          'exit_status': stdout.channel.recv_exit_status()}
         finally:
-            if self.client is not None:
-                self.client.close()
-                self.client = None
+            stdout.channel.close()
+
+        if result['exit_status'] is not expected_exit_status:
+            msg = "Error running %s." % command
+            msg = "\n".join([msg, "Error:%s" % result['stderr']])
+            msg = "\n".join([msg,
+                             "Exit status:%s" % result['exit_status']])
+            raise Exception(msg)
+        else:
+            if self.debug is True:
+                out = 'None'
+                if ('stdout' in result and
+                    result['stdout'] is not None and
+                    len(result['stdout']) is not 0):
+                    out = result['stdout']
+
+                print("stdout:%s" % out)
+
+            return result
 
 
 class Deployer(object):
 
-    def __init__(self, branch_or_tag, environment, tier, deploy_dir='espa-site', debug=False):
+    def __init__(self, branch_or_tag, environment, tier, deploy_dir='espa-site', debug=False,
+                 timeout=None, git_mirror=False):
         
         # tier is defined in settings
         if tier not in settings.tiers:
@@ -163,8 +355,23 @@ class Deployer(object):
         
         # Instantiate a remote client to the remote host
         self.remote_client = RemoteHost(self.host, self.user, debug=debug)
+
+        # Set by deploy_many to have all hosts relink at the same time
+        self.relink_barrier = None
+
+        # Seconds the long running commands (git, pip) are allowed
+        self.timeout = timeout
+        self.verbose = False
+
+        # Fetch into a bare mirror kept on the host instead of cloning afresh
+        self.git_mirror = git_mirror
         
 
+    def show_output(self, line, name):
+        ''' Prints the output of long running commands as it comes in '''
+        if self.verbose is True:
+            print(line.rstrip('\n'))
+
     def __pre_initialize__(self, *args, **kwargs):
         ''' Hook to perform actions before to initialization '''
         pass
@@ -234,15 +441,35 @@ class Deployer(object):
                                                         str(now.minute).zfill(2),
                                                         str(now.second).zfill(2))
                                                      
+        # Each tier stages in a directory of its own, several tiers may be
+        # deployed to the same host at once
+        self.staging = '~/staging/{0}'.format(self.tier)
+
         # Initilize the target deployment directory
-        self.initialize = ('rm -rf ~/staging;'
-                           'mkdir ~/staging;'
-                           'mkdir -p ~/deployments')
+        self.initialize = ('rm -rf {0};'
+                           'mkdir -p {0};'
+                           'mkdir -p ~/deployments'.format(self.staging))
         
         # Pull the project from git
-        git = 'git clone --depth 1 --branch {0} {1} {2}'
+        if self.git_mirror is True:
+            # Only what changed since the last deploy is fetched into the
+            # mirror, the tree of the branch or tag is exported from there.
+            # A new mirror is cloned aside and moved in place once complete,
+            # or removed when the clone fails
+            git = ('M=~/.git-mirrors/{2}.git; '
+                   'if [ ! -d $M ]; then '
+                   'mkdir -p ~/.git-mirrors && '
+                   '(git clone --mirror {1} $M.$$ || (rm -rf $M.$$; false)) && '
+                   '(mv -T $M.$$ $M 2>/dev/null || rm -rf $M.$$); fi && '
+                   'git --git-dir=$M remote set-url origin {1} && '
+                   'git --git-dir=$M fetch --prune origin && '
+                   'mkdir {2} && '
+                   'git --git-dir=$M archive -o {2}.tar {0} && '
+                   'tar -xf {2}.tar -C {2} && rm {2}.tar')
+        else:
+            git = 'git clone --depth 1 --branch {0} {1} {2}'
         git = git.format(self.branch_or_tag, self.repo, self.tier)
-        self.git = 'cd ~/staging;{0}'.format(git)
+        self.git = 'cd {0};{1}'.format(self.staging, git)
 
         # Remove previous deployments
         self.delete_old = 'rm -rf ~/deployments/{0}*'.format(self.deploy_dir)
@@ -251,8 +478,8 @@ class Deployer(object):
                                    .format(self.deployment_name))
         
         # Move staged code to deployments
-        self.move = 'mv ~/staging/{0} {1}'.format(self.tier,
-                                                  self.deployment_location)
+        self.move = 'mv {0}/{1} {2}'.format(self.staging, self.tier,
+                                            self.deployment_location)
                                                                                             
         # Relink deploy_dir to point to the new deployment
         self.relink = ('rm ~/{1}; '
@@ -260,7 +487,7 @@ class Deployer(object):
                        .format(self.deployment_name, self.deploy_dir))
 
         # Clean up staging dir again.  Already done once in initialize                 
-        self.cleanup = 'rm -rf ~/staging'
+        self.cleanup = 'rm -rf {0}'.format(self.staging)
 
         if verbose is True:
             print('Deploying %s to %s' % (self.branch_or_tag,
@@ -292,7 +519,9 @@ class Deployer(object):
             print("Pulling from Git...")
 
         # pull the code down from git
-        self.remote_client.execute(command=self.git, expected_exit_status=0)
+        self.remote_client.execute(command=self.git, expected_exit_status=0,
+                                   stream=True, callback=self.show_output,
+                                   timeout=self.timeout)
 
         if verbose is True:
             print('Calling post-git-hook ...')
@@ -334,6 +563,12 @@ class Deployer(object):
 
         self.__post_move__(*args, **kwargs)
 
+        if self.relink_barrier is not None:
+            if verbose is True:
+                print('Waiting for the other deployments before relinking...')
+
+            self.relink_barrier.wait()
+
         if verbose is True:
             print('Calling pre-relink hook...')
 
@@ -378,15 +613,69 @@ class Deployer(object):
 
 
 class WebappDeployer(Deployer):
-    ''' Deploys the espa-web project '''
+    ''' Deploys the espa-web project.
+
+    Requirements are installed from a wheelhouse shared by the deployments
+    of a host, ~/.wheelhouse/<sha1 of setup/requirements.txt>, which is only
+    built when the requirements change.  With reuse_virtualenv, the
+    virtualenv of the current deployment is copied into the staged code
+    instead when it was made from the same requirements, before any
+    previous release is deleted '''
+
+    # identifies the requirements a virtualenv or wheelhouse was made from
+    requirements_sha1 = 'sha1sum setup/requirements.txt | cut -c1-40'
+
     def __init__(self, *args, **kwargs):
+        self.wheelhouse = kwargs.pop('wheelhouse', True)
+        self.reuse_virtualenv = kwargs.pop('reuse_virtualenv', False)
+        self.reused_virtualenv = False
         super(WebappDeployer, self).__init__(*args, **kwargs)
-        
+
+    def __post_git__(self, *args, **kwargs):
+        # copy the virtualenv into the staged code now, the current
+        # deployment is gone after delete_old with delete_previous_releases
+        super(WebappDeployer, self).__post_git__(*args, **kwargs)
+
+        self.reused_virtualenv = False
+        if self.reuse_virtualenv is not True:
+            return
+
+        # the copied scripts and symlinks (local/ holds absolute ones) point
+        # at the old location, hence the sed and relinking to where the
+        # code is about to be moved
+        reuse_env = ('cd {0}/{1}; '
+                     'NEW=$(cd ~ && pwd -P)/deployments/{2}; '
+                     'OLD=$(readlink -f ~/{3}); '
+                     'SHA=$({4}); '
+                     'if [ -n "$OLD" ] && [ "$OLD" != "$NEW" ] && '
+                     '[ "$(cat $OLD/.requirements.sha1 2>/dev/null)" = "$SHA" ]; then '
+                     'for d in bin include lib lib64 local pyvenv.cfg; do '
+                     '[ -e $OLD/$d ] && cp -a $OLD/$d . ; done; '
+                     'find bin include lib lib64 local -lname "$OLD/*" 2>/dev/null | '
+                     'while read l; do t=$(readlink "$l"); '
+                     'ln -sfn "$NEW${{t#$OLD}}" "$l"; done; '
+                     'grep -rlI "$OLD" bin pyvenv.cfg 2>/dev/null | '
+                     'xargs -r sed -i "s#$OLD#$NEW#g"; '
+                     'echo $SHA > .requirements.sha1; '
+                     'echo reused; fi'
+                     .format(self.staging, self.tier, self.deployment_name,
+                             self.deploy_dir, self.requirements_sha1))
+
+        print('Looking for a virtualenv to reuse')
+        result = self.remote_client.execute(command=reuse_env,
+                                            expected_exit_status=0)
+        if 'reused\n' in result['stdout']:
+            print('Reused the virtualenv of the previous deployment')
+            self.reused_virtualenv = True
+
     def __post_move__(self, *args, **kwargs):
         # create the virtualenv after the code has been put into 
         # the deploy directory
         super(WebappDeployer, self).__post_move__(*args, **kwargs)
-        
+
+        if self.reused_virtualenv is True:
+            return
+
         virtual_env = 'cd {0}; virtualenv .'.format(self.deployment_location)
         print('Creating virtualenv at {0}'.format(self.deployment_location))
         self.remote_client.execute(command=virtual_env,
@@ -398,14 +687,35 @@ class WebappDeployer(Deployer):
         if 'espa-api' in self.deployment_location:
             tmpdir_cmd = 'mkdir -p {0}/tmp; export TMPDIR={0}/tmp;'.format(self.deployment_location)
 
+        if self.wheelhouse is True:
+            # built aside and moved in place, so a wheelhouse is always
+            # complete, a failed build leaves nothing behind
+            requirements = ('pip install --upgrade pip wheel && '
+                            'WH=~/.wheelhouse/$({0}) && '
+                            'if [ ! -d $WH ]; then '
+                            'mkdir -p ~/.wheelhouse && '
+                            '(pip wheel -w $WH.$$ -r setup/requirements.txt || '
+                            '(rm -rf $WH.$$; false)) && '
+                            '(mv -T $WH.$$ $WH 2>/dev/null || rm -rf $WH.$$); fi && '
+                            'pip install --no-index --find-links $WH '
+                            '-r setup/requirements.txt'
+                            .format(self.requirements_sha1))
+        else:
+            requirements = ('pip install --upgrade pip; '
+                            'pip install -r setup/requirements.txt')
+
         pip_install = ('{1}'
                        'cd {0}; '
                        '. bin/activate; '
-                       'pip install --upgrade pip; pip install -r setup/requirements.txt'
-                      .format(self.deployment_location, tmpdir_cmd))
+                       '{2} && '
+                       '{3} > .requirements.sha1'
+                      .format(self.deployment_location, tmpdir_cmd,
+                              requirements, self.requirements_sha1))
 
         print('Installing requirements')
-        self.remote_client.execute(command=pip_install, expected_exit_status=0)
+        self.remote_client.execute(command=pip_install, expected_exit_status=0,
+                                   stream=True, callback=self.show_output,
+                                   timeout=self.timeout)
 
 
 class ProductionDeployer(Deployer):
@@ -434,15 +744,9 @@ class MaintenanceDeployer(Deployer):
                                    expected_exit_status=0)
 
 
-''' Module level method to support deploying projects to the espa system.
-    If in doubt, you should be calling this method rather than any of the 
-    classes directly '''
-def deploy(branch_or_tag,
-           environment,
-           tier,
-           delete_previous_releases,
-           verbose,
-           debug):
+''' Module level method creating the deployer matching a tier '''
+def make_deployer(branch_or_tag, environment, tier, debug, timeout=None,
+                  wheelhouse=True, reuse_virtualenv=False, git_mirror=False):
 
     deployer = None
 
@@ -451,32 +755,158 @@ def deploy(branch_or_tag,
                                   environment=environment,
                                   tier=tier,
                                   debug=debug,
+                                  timeout=timeout,
+                                  git_mirror=git_mirror,
+                                  wheelhouse=wheelhouse,
+                                  reuse_virtualenv=reuse_virtualenv,
                                   deploy_dir='espa-web')
     elif tier == 'espa-production':
         deployer = ProductionDeployer(branch_or_tag=branch_or_tag,
                                       environment=environment,
                                       tier=tier,
-                                      debug=debug)
+                                      debug=debug,
+                                      timeout=timeout,
+                                      git_mirror=git_mirror)
     elif tier == 'espa-maintenance':
         deployer = MaintenanceDeployer(branch_or_tag=branch_or_tag,
                                        environment=environment,
                                        tier=tier,
-                                       debug=debug)
+                                       debug=debug,
+                                       timeout=timeout,
+                                       git_mirror=git_mirror)
     elif tier == 'espa-api':
         deployer = WebappDeployer(branch_or_tag=branch_or_tag,
                                   environment=environment,
                                   tier=tier,
                                   debug=debug,
+                                  timeout=timeout,
+                                  git_mirror=git_mirror,
+                                  wheelhouse=wheelhouse,
+                                  reuse_virtualenv=reuse_virtualenv,
                                   deploy_dir='espa-api')
     else:
         raise TypeError('{0} is not a recognized tier... exiting'.format(tier))
 
+    return deployer
+
+
+''' Module level method to support deploying projects to the espa system.
+    If in doubt, you should be calling this method rather than any of the 
+    classes directly '''
+def deploy(branch_or_tag,
+           environment,
+           tier,
+           delete_previous_releases,
+           verbose,
+           debug,
+           timeout=None,
+           wheelhouse=True,
+           reuse_virtualenv=False,
+           git_mirror=False):
+
+    deployer = make_deployer(branch_or_tag, environment, tier, debug, timeout,
+                             wheelhouse, reuse_virtualenv, git_mirror)
+
     if deployer is not None:
-        deployer.deploy(delete_previous_releases, verbose)
+        with deployer.remote_client:
+            deployer.deploy(delete_previous_releases, verbose)
     else:
         print('deployer was None... exiting')
 
 
+''' Module level method deploying several tiers of an environment at once.
+    At most workers deployments run concurrently, the output of each is
+    prefixed with its tier and host.  Tiers sharing a host and deploy
+    directory (espa-production and espa-maintenance both use espa-site)
+    are deployed one after another by the same worker.  With relink_together,
+    no host relinks before all of them have their new code in place, the
+    later tiers of a shared host and directory relink after the first one.
+    Failures are reported together in a DeploymentError once every
+    deployment has finished '''
+def deploy_many(branch_or_tag,
+                environment,
+                tiers,
+                delete_previous_releases,
+                verbose,
+                debug,
+                workers=4,
+                relink_together=False,
+                timeout=None,
+                wheelhouse=True,
+                reuse_virtualenv=False,
+                git_mirror=False):
+
+    if 'all' in tiers:
+        tiers = sorted(settings.environments[environment]['tiers'].keys())
+    tiers = [t for i, t in enumerate(tiers) if t not in tiers[:i]]
+
+    deployers = [make_deployer(branch_or_tag, environment, tier, debug, timeout,
+                               wheelhouse, reuse_virtualenv, git_mirror)
+                 for tier in tiers]
+
+    groups = OrderedDict()
+    for deployer in deployers:
+        groups.setdefault((deployer.host, deployer.deploy_dir), []).append(deployer)
+    groups = list(groups.values())
+
+    barrier = None
+    if relink_together is True:
+        if workers < len(groups):
+            raise ValueError('Relinking together needs a worker per host, '
+                             '%s workers for %s hosts' % (workers, len(groups)))
+        # only the first deployment of each group waits, the others start
+        # once it is done
+        barrier = Barrier(len(groups))
+        for group in groups:
+            group[0].relink_barrier = barrier
+
+    output = PrefixedOutput(sys.stdout)
+
+    def run(deployer):
+        output.set_prefix('[%s@%s] ' % (deployer.tier, deployer.host))
+        try:
+            if barrier is not None and barrier.aborted:
+                raise BarrierAborted('Another deployment failed, not deploying')
+            with deployer.remote_client:
+                deployer.deploy(delete_previous_releases, verbose)
+            return None
+        except Exception:
+            if barrier is not None:
+                barrier.abort()
+            error = traceback.format_exc()
+            print(error.rstrip())
+            return error
+        finally:
+            output.flush()
+
+    def run_group(group):
+        return [run(deployer) for deployer in group]
+
+    sys.stdout = output
+    pool = ThreadPool(processes=min(workers, len(groups)))
+    try:
+        results = pool.map(run_group, groups, chunksize=1)
+    except Exception:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+        sys.stdout = output.stream
+
+    failed = [(d, e) for group, errors in zip(groups, results)
+              for d, e in zip(group, errors) if e is not None]
+    if failed:
+        msg = ['%s of %s deployments failed' % (len(failed), len(deployers))]
+        for deployer, error in failed:
+            msg.append('%s on %s:\n%s' % (deployer.tier, deployer.host, error))
+        raise DeploymentError('\n'.join(msg))
+
+    print('%s sucessfully deployed to %s on %s' % (branch_or_tag, environment,
+                                                   ', '.join(tiers)))
+
+
 if __name__ == '__main__':
 
     description = "Deploys & installs ESPA projects into the named environment"
@@ -486,7 +916,9 @@ if __name__ == '__main__':
     parser.add_argument("--tier",
                         choices=settings.tiers,
                         required=True,
-                        help="Project to deploy.")
+                        nargs='+',
+                        help="Project(s) to deploy, several are deployed "
+                             "concurrently")
 
     parser.add_argument("--environment",
                         required=True,
@@ -509,14 +941,62 @@ if __name__ == '__main__':
                         required=True,
                         help="Name of branch or tag to deploy")
 
+    parser.add_argument("--workers",
+                        type=int,
+                        default=4,
+                        help="Deployments to run at once with several tiers")
+
+    parser.add_argument("--relink_together",
+                        action="store_true",
+                        help="With several tiers, relink all of them only "
+                             "once every one is ready")
+
+    parser.add_argument("--timeout",
+                        type=int,
+                        default=None,
+                        help="Seconds after which git or pip are stopped")
+
+    parser.add_argument("--no_wheelhouse",
+                        action="store_true",
+                        help="Install requirements from the index, not the "
+                             "wheelhouse cached on the host")
+
+    parser.add_argument("--reuse_virtualenv",
+                        action="store_true",
+                        help="Copy the virtualenv of the current deployment "
+                             "when the requirements did not change")
+
+    parser.add_argument("--git_mirror",
+                        action="store_true",
+                        help="Fetch into a mirror kept on the host rather "
+                             "than cloning the repository again")
+
     args = parser.parse_args()
 
     if args.debug is True:
         args.verbose = True
 
-    deploy(args.branch_or_tagname,
-           args.environment,
-           args.tier,
-           args.delete_previous_releases,
-           args.verbose,
-           args.debug)
+    if len(args.tier) == 1 and 'all' not in args.tier:
+        deploy(args.branch_or_tagname,
+               args.environment,
+               args.tier[0],
+               args.delete_previous_releases,
+               args.verbose,
+               args.debug,
+               args.timeout,
+               not args.no_wheelhouse,
+               args.reuse_virtualenv,
+               args.git_mirror)
+    else:
+        deploy_many(args.branch_or_tagname,
+                    args.environment,
+                    args.tier,
+                    args.delete_previous_releases,
+                    args.verbose,
+                    args.debug,
+                    args.workers,
+                    args.relink_together,
+                    args.timeout,
+                    not args.no_wheelhouse,
+                    args.reuse_virtualenv,
+                    args.git_mirror)
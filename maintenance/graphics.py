@@ -4,6 +4,11 @@
 import os
 import datetime
 import logging
+import multiprocessing as mp
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
 import pandas as pd
 import pandas.io.sql as sqlio
@@ -15,11 +20,13 @@ import numpy as np
 import matplotlib as mpl
 mpl.use('Agg')
 import matplotlib.pyplot as plt
+import mpl_toolkits.basemap
 from mpl_toolkits.basemap import Basemap
 from matplotlib.collections import PatchCollection
 from matplotlib.patches import Polygon
 from matplotlib.ticker import FuncFormatter
 
+import dbconnect
 from dbconnect import DBConnect
 
 FIGSIZE = (16, 9)
@@ -27,6 +34,64 @@ MINALPHA = 0.035
 MAXALPHA = 1.0
 COLOR = '#e31a1c'
 
+# The static layers of the heatmaps (map projection, pre-rendered land and
+# water) are built once and kept here between runs
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'espa-graphics')
+BASEMAP_ARGS = dict(llcrnrlon=-180, llcrnrlat=-85,
+                    urcrnrlon=180, urcrnrlat=85,
+                    projection='mill')
+BACKGROUND_DPI = 200
+# Processes rendering heatmaps at once
+HEATMAP_PROCESSES = 4
+# Bumped when the layout of the WRS2 index cache changes
+WRS_INDEX_VERSION = 1
+
+# Built once per process, see get_basemap, get_background, get_wrs
+# and get_wrs_index
+_basemap = []
+_backgrounds = {}
+_wrs = {}
+_wrs_index = {}
+
+# Scenes ordered per path/row
+# formatted with the start and end dates, and an extra email condition
+SCENE_COUNT_SQL = '''
+    select  count(*) n_scenes,
+            case when split_part(s.name, '_', 2) = ''
+                then right(left(s.name,6),3)
+                else left(split_part(s.name, '_', 3), 3) end as path,
+
+            case when split_part(s.name, '_', 2) = ''
+                then right(left(s.name,9),3)
+                else right(split_part(s.name, '_', 3), 3) end as row
+
+    from ordering_scene s
+    left join ordering_order o on o.id=s.order_id
+
+    where
+        o.order_date::date >= '{0}'
+        and o.order_date::date <= '{1}'
+        and s.sensor_type = 'landsat'
+        {2}
+
+    group by path, row
+
+    ;
+    '''
+
+# formatted with the start and end dates
+SENSOR_COUNT_SQL = '''
+    select count(s.name) n_scenes,
+            left(s.name, 4) sensor,
+            extract(month from o.order_date) mm,
+            extract(year from o.order_date) yy
+    from ordering_scene s
+        join ordering_order o on o.id=s.order_id
+    where o.order_date::date >= '{0}'
+        and o.order_date::date <= '{1}'
+        and s.sensor_type = 'landsat'
+    group by sensor, yy, mm'''
+
 
 def load_wrs(filename='wrs2_asc_desc/wrs2_asc_desc.shp'):
     """Read WRS2 features shapefile."""
@@ -36,6 +101,184 @@ def load_wrs(filename='wrs2_asc_desc/wrs2_asc_desc.shp'):
     return wrs
 
 
+def cache_path(name):
+    """Location of a cached file of the static map layers."""
+    if not os.path.exists(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+    return os.path.join(CACHE_DIR, name)
+
+
+def map_key():
+    """
+    Projection and the Basemap/matplotlib versions, part of the name of every
+    cached layer so a library upgrade or a new projection rebuilds them.
+    """
+    proj = '_'.join('{}{}'.format(k, v) for k, v in sorted(BASEMAP_ARGS.items()))
+    return 'basemap{}_mpl{}_{}'.format(mpl_toolkits.basemap.__version__,
+                                       mpl.__version__, proj)
+
+
+def get_wrs(filename='wrs2_asc_desc/wrs2_asc_desc.shp'):
+    """WRS2 features, read from the shapefile once per process."""
+    if filename not in _wrs:
+        _wrs[filename] = load_wrs(filename)
+    return _wrs[filename]
+
+
+def wrs_code(path, row):
+    """Single integer key of a path/row, used by the WRS2 index."""
+    return np.asarray(path, dtype=np.int64) * 1000 + np.asarray(row, dtype=np.int64)
+
+
+def build_wrs_index(features, mapm):
+    """
+    Project the outline of every WRS2 path/row once.
+
+    Outlines crossing the dateline are wrapped west before projection,
+    as make_basemap used to do for each patch.
+
+    Returns:
+        dict: codes (sorted wrs_code of each feature), offsets (start of
+              each outline in xy, plus the end) and xy (projected vertices)
+    """
+    codes = wrs_code(features['PATH'].values, features['ROW'].values)
+    order = np.argsort(codes, kind='mergesort')
+    geoms = features.geometry.values
+
+    offsets = np.zeros(len(order) + 1, dtype=np.int64)
+    lons, lats = [], []
+    for i, ix in enumerate(order):
+        ln, la = get_poly_wrs(geoms[ix])
+        ln = np.asarray(ln, dtype=np.float64)
+        if ln.max() - ln.min() > 180:
+            # International dateline longitude wrap-around
+            ln = np.where(ln > 0, ln - 360, ln)
+        lons.append(ln)
+        lats.append(np.asarray(la, dtype=np.float64))
+        offsets[i + 1] = offsets[i] + len(ln)
+
+    x, y = mapm(np.concatenate(lons), np.concatenate(lats))
+    return {'codes': codes[order],
+            'offsets': offsets,
+            'xy': np.column_stack((x, y))}
+
+
+def get_wrs_index(filename='wrs2_asc_desc/wrs2_asc_desc.shp'):
+    """
+    Projected WRS2 outlines, see build_wrs_index.  Kept in a NumPy file
+    under CACHE_DIR, rebuilt when the shapefile or projection changes.
+    """
+    if filename in _wrs_index:
+        return _wrs_index[filename]
+
+    st = os.stat(filename)
+    meta = [WRS_INDEX_VERSION, st.st_size, int(st.st_mtime)]
+    path = cache_path('wrs_{}_{}.npz'.format(
+        os.path.splitext(os.path.basename(filename))[0], map_key()))
+
+    index = None
+    if os.path.exists(path):
+        try:
+            with np.load(path) as npz:
+                index = {k: npz[k] for k in npz.files}
+        except Exception:
+            logging.warning('Unreadable WRS2 index %s, rebuilding', path)
+        if index is not None and list(index.pop('meta', [])) != meta:
+            index = None
+
+    if index is None:
+        logging.info('Build WRS2 index %s', path)
+        index = build_wrs_index(get_wrs(filename), get_basemap())
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as fid:
+            np.savez(fid, meta=np.array(meta, dtype=np.int64), **index)
+        os.rename(tmp_path, path)
+
+    _wrs_index[filename] = index
+    return index
+
+
+def wrs_outlines(paths, rows, index):
+    """
+    Look up the projected outlines of path/rows in the WRS2 index.
+
+    Returns:
+        list: one (n, 2) array of map coordinates per path/row
+    """
+    codes = index['codes']
+    want = wrs_code(paths, rows)
+    ix = np.searchsorted(codes, want)
+    ix = np.minimum(ix, len(codes) - 1)
+    found = codes[ix] == want
+    unique = np.append(codes[1:] != codes[:-1], True)[ix]
+    bad = want[~(found & unique)]
+    if len(bad):
+        raise AssertionError('Non-unique path/row ({}_{}) in shapefile!'
+                             .format(bad[0] // 1000, bad[0] % 1000))
+
+    offsets, xy = index['offsets'], index['xy']
+    return [xy[offsets[i]:offsets[i + 1]] for i in ix]
+
+
+def get_basemap():
+    """Miller projection of the heatmaps, unpickled from the cache when possible."""
+    if _basemap:
+        return _basemap[0]
+
+    path = cache_path('basemap_{}.pickle'.format(map_key()))
+    mapm = None
+    if os.path.exists(path):
+        try:
+            with open(path, 'rb') as fid:
+                mapm = pickle.load(fid)
+        except Exception:
+            logging.warning('Unreadable basemap cache %s, rebuilding', path)
+
+    if mapm is None:
+        mapm = Basemap(**BASEMAP_ARGS)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as fid:
+            pickle.dump(mapm, fid, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+
+    _basemap.append(mapm)
+    return mapm
+
+
+def get_background(water='white', earth='grey'):
+    """
+    Water, land, coastlines and country borders of the heatmaps,
+    rendered once into an image covering the map extent exactly.
+    """
+    key = (water, earth)
+    if key in _backgrounds:
+        return _backgrounds[key]
+
+    mapm = get_basemap()
+    path = cache_path('background_{}_{}_{}x{}_{}_{}.png'.format(
+        water, earth, FIGSIZE[0], FIGSIZE[1], BACKGROUND_DPI, map_key()).replace('#', ''))
+    if not os.path.exists(path):
+        logging.info('Render map background %s', path)
+        fig = plt.figure(figsize=FIGSIZE)
+        ax = fig.add_axes([0, 0, 1, 1])
+        mapm.drawmapboundary(fill_color=water, ax=ax)
+        mapm.fillcontinents(color=earth, lake_color=water, ax=ax)
+        mapm.drawcoastlines(ax=ax)
+        mapm.drawcountries(ax=ax)
+        # Stretch the map over the whole image, imshow puts it back in shape
+        ax.set_aspect('auto')
+        ax.set_xlim(mapm.llcrnrx, mapm.urcrnrx)
+        ax.set_ylim(mapm.llcrnry, mapm.urcrnry)
+        ax.axis('off')
+        tmp_path = '{}.{}.tmp.png'.format(path, os.getpid())
+        fig.savefig(tmp_path, dpi=BACKGROUND_DPI, facecolor=water)
+        plt.close(fig)
+        os.rename(tmp_path, path)
+
+    _backgrounds[key] = plt.imread(path)
+    return _backgrounds[key]
+
+
 def query_scene_count(dbinfo, start, end, who=None):
     """Query count of scenes ordered per path/row.
 
@@ -48,41 +291,19 @@ def query_scene_count(dbinfo, start, end, who=None):
         np.array: number of scenes per path/row
 
     """
-    sql = '''
-        select  count(*) n_scenes,
-                case when split_part(s.name, '_', 2) = ''
-                    then right(left(s.name,6),3)
-                    else left(split_part(s.name, '_', 3), 3) end as path,
-
-                case when split_part(s.name, '_', 2) = ''
-                    then right(left(s.name,9),3)
-                    else right(split_part(s.name, '_', 3), 3) end as row
-
-        from ordering_scene s
-        left join ordering_order o on o.id=s.order_id
-
-        where
-            o.order_date::date >= '{0}'
-            and o.order_date::date <= '{1}'
-            and s.sensor_type = 'landsat'
-            {2}
-
-        group by path, row
-
-        ;
-        '''
-
     email_str = '' if who is 'ALL' else ("and o.email = '%s'" % who)
 
     with DBConnect(**dbinfo) as db:
-        dat = sqlio.read_sql_query(sql.format(start, end, email_str), db.conn)
+        dat = sqlio.read_sql_query(SCENE_COUNT_SQL.format(start, end, email_str), db.conn)
 
     dat['path'] = dat['path'].astype(int)
     dat['row'] = dat['row'].astype(int)
-    dat['alpha'] = dat['n_scenes'].apply(lambda v: get_alpha
-                                         (v, MAXALPHA, MINALPHA,
-                                          dat['n_scenes'].min(),
-                                          dat['n_scenes'].max()))
+    mmin, mmax = dat['n_scenes'].min(), dat['n_scenes'].max()
+    if mmin == mmax:
+        dat['alpha'] = MAXALPHA
+    else:
+        dat['alpha'] = get_alpha(dat['n_scenes'].values.astype(np.float64),
+                                 MAXALPHA, MINALPHA, mmin, mmax)
     dat = dat.sort_values(by='alpha')
     return (
         dat[['path', 'row', 'alpha']].values,
@@ -91,68 +312,47 @@ def query_scene_count(dbinfo, start, end, who=None):
     )
 
 
-def get_poly_wrs(path, row, features=None, facecolor='w'):
-    """Extract longitude/latitude box for a path/row from shapefile."""
-    prid = '{}_{}'.format(path, row)
-    ix = (features['PATH'] == path) & (features['ROW'] == row)
-    geom = features[ix]
-
-    if (len(geom) != 1):
-        raise AssertionError('Non-unique path/row (%s) in shapefile!', prid)
-
-    poly = geom.geometry.values[0]
-    if poly.geom_type == 'Polygon':
-        lons, lats = poly.exterior.coords.xy
-    elif poly.geom_type == 'MultiPolygon':
+def get_poly_wrs(geom):
+    """Extract longitude/latitude box of a path/row shape from the shapefile."""
+    if geom.geom_type == 'Polygon':
+        lons, lats = geom.exterior.coords.xy
+    elif geom.geom_type == 'MultiPolygon':
         lons, lats = [], []
-        for subpoly in poly:
+        for subpoly in geom:
             ln, la = subpoly.exterior.coords.xy
             lons += ln
             lats += la
     return lons, lats
 
 
-def plot_poly(lons, lats, mapm, **kwargs):
-    """Convert bounding box into a styled Patch object."""
-    return Polygon(zip(*mapm(lons, lats)), **kwargs)
-
-
 def make_basemap(path_rows_alpha,
                  water='white', earth='grey', color=COLOR):
     """Create a heatmap of WRS2 path/rows ordered."""
     fig, ax = plt.subplots(figsize=FIGSIZE)
-    mapm = Basemap(
-        llcrnrlon=-180, llcrnrlat=-85,
-        urcrnrlon=180, urcrnrlat=85,
-        projection='mill'
-    )
-
-    features = load_wrs()
+    mapm = get_basemap()
+    index = get_wrs_index()
 
-    mapm.drawmapboundary()
-    mapm.drawcoastlines()
-    mapm.fillcontinents(color=earth, lake_color=water)
-    mapm.drawmapboundary(fill_color=water)
-    mapm.drawcountries()
+    ax.imshow(get_background(water, earth), interpolation='bilinear', zorder=0,
+              extent=(mapm.llcrnrx, mapm.urcrnrx, mapm.llcrnry, mapm.urcrnry))
+    mapm.drawmapboundary(fill_color='none', ax=ax)
     mapm.drawmeridians(np.arange(-180, 180, 60),
                        labels=[False, False, False, True])
     mapm.drawparallels(np.arange(-80, 80, 20),
                        labels=[True, False, False, False])
 
     ax = plt.gca()
-    for path, row, alpha in path_rows_alpha:
-        lons, lats = get_poly_wrs(path, row, features)
-        delta_lons = abs(max(lons) - min(lons))
-        if delta_lons > 180:
-            def p_dateline(x):
-                """International dateline longitude wrap-around."""
-                if x > 0:
-                    return x-360
-                return x
-            lons = map(p_dateline, lons)
-        patch = plot_poly(lons, lats, mapm, facecolor=color, edgecolor=color,
-                          alpha=alpha)
-        ax.add_patch(patch)
+    path_rows_alpha = np.asarray(path_rows_alpha)
+    if not len(path_rows_alpha):
+        return
+    outlines = wrs_outlines(path_rows_alpha[:, 0].astype(int),
+                            path_rows_alpha[:, 1].astype(int), index)
+
+    # One colour, the alpha of each face scaled from its scene count
+    rgba = np.tile(mpl.colors.to_rgba(color), (len(outlines), 1))
+    rgba[:, 3] = path_rows_alpha[:, 2]
+    patches = PatchCollection([Polygon(xy) for xy in outlines],
+                              facecolors=rgba, edgecolors=rgba)
+    ax.add_collection(patches)
 
 
 def get_alpha(x, b, a, mmin, mmax):
@@ -189,44 +389,83 @@ def scrub_email(address):
         return address
 
 
-def pathrow_heatmap(dbinfo, start, end, user='ALL', color=COLOR):
-    """Create graphic for number of scenes per path/row."""
-    alphas, mmin, mmax = query_scene_count(dbinfo, start, end, user)
+def render_heatmap(args):
+    """
+    Draw and save one path/row heatmap, arguments packed in a tuple
+    (alphas, mmin, mmax, user, start, end, color, pltfname) so this can
+    be handed to a multiprocessing pool.
+    """
+    alphas, mmin, mmax, user, start, end, color, pltfname = args
     cb = create_fake_cb(mmin, mmax, color)
-    make_basemap(alphas)
-    user = scrub_email(address=user)
+    make_basemap(alphas, color=color)
     plt.title('Landsat Scenes (path/row) Ordered\nUSER {}: {} - {}'
               .format(user, start, end), fontsize=14)
     cbar = plt.colorbar(cb)
     cbar.ax.set_title('  Scenes', weight='bold', fontsize=14)
     cbar.ax.tick_params(labelsize=12)
-    pltfname = '/tmp/paths_rows_ordered_{}.png'.format(user)
-    # check if we already generated a PNG with this filename
-    # might happen if multiple users w/ same domain are in top 3
-    i = 1
-    while os.path.exists(pltfname):
-        pltfname = '/tmp/paths_rows_ordered_{}_{}.png'.format(user, i)
-        i += 1
     plt.savefig(pltfname, bbox_inches='tight')
+    plt.close('all')
     return pltfname
 
 
+def pathrow_heatmaps(dbinfo, start, end, users, color=COLOR,
+                     processes=HEATMAP_PROCESSES):
+    """
+    Create graphics for number of scenes per path/row, one per user.
+
+    The scene counts are queried here, the maps are drawn in parallel
+    processes which share the static layers built beforehand.
+
+    Returns:
+        list: file names of the graphics, in the order of users
+    """
+    jobs, taken = [], set()
+    for user in users:
+        alphas, mmin, mmax = query_scene_count(dbinfo, start, end, user)
+        user = scrub_email(address=user)
+        pltfname = '/tmp/paths_rows_ordered_{}.png'.format(user)
+        # check if we already generated a PNG with this filename
+        # might happen if multiple users w/ same domain are in top 3
+        i = 1
+        while pltfname in taken or os.path.exists(pltfname):
+            pltfname = '/tmp/paths_rows_ordered_{}_{}.png'.format(user, i)
+            i += 1
+        taken.add(pltfname)
+        jobs.append((alphas, mmin, mmax, user, start, end, color, pltfname))
+
+    # Forked workers inherit these instead of each building them
+    get_basemap()
+    get_background()
+    get_wrs_index()
+
+    if processes > 1 and len(jobs) > 1:
+        # the workers must not inherit pooled database connections
+        dbconnect.refresh_pool(**dbinfo)
+        pool = mp.Pool(processes=min(processes, len(jobs)))
+        try:
+            files = pool.map(render_heatmap, jobs, chunksize=1)
+        except Exception:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+    else:
+        files = map(render_heatmap, jobs)
+
+    return files
+
+
+def pathrow_heatmap(dbinfo, start, end, user='ALL', color=COLOR):
+    """Create graphic for number of scenes per path/row."""
+    return pathrow_heatmaps(dbinfo, start, end, [user], color, processes=1)[0]
+
+
 def query_sensor_count(dbinfo, start, end, sensors=None):
     """Select aggregate number of scenes sorted by sensor."""
-    sql = '''
-        select count(s.name) n_scenes,
-                left(s.name, 4) sensor,
-                extract(month from o.order_date) mm,
-                extract(year from o.order_date) yy
-        from ordering_scene s
-            join ordering_order o on o.id=s.order_id
-        where o.order_date::date >= '{0}'
-            and o.order_date::date <= '{1}'
-            and s.sensor_type = 'landsat'
-        group by sensor, yy, mm'''
-
     with DBConnect(**dbinfo) as db:
-        dat = sqlio.read_sql_query(sql.format(start, end), db.conn)
+        dat = sqlio.read_sql_query(SENSOR_COUNT_SQL.format(start, end), db.conn)
 
     d2 = dat.pivot_table(index='mm', values='n_scenes',
                          columns='sensor').fillna(0)
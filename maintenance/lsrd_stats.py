@@ -8,24 +8,74 @@ import argparse
 import subprocess
 import traceback
 import os
-from collections import defaultdict
-import gzip
+import json
+from collections import defaultdict, OrderedDict
 import urllib2
 import logging
 import sys
+import time
+import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
+# strptime lazily imports this on first use, which is not thread-safe
+import _strptime
+
+import numpy as np
 
 logging.basicConfig(level='INFO', stream=sys.stderr)
 logger = logging.getLogger(__name__)
 
+import dbconnect
 from dbconnect import DBConnect
 import utils
+import weblogs
+import profiling
 import graphics
 
 DATE_FMT = '%Y-%m-%d'
 LOG_FILENAME = 'edclpdsftp.cr.usgs.gov-' # Change to ssl-access-log
 LOG_FILE_TIMESTAMP = '%Y%m%d' + '.gz'
 
+# Concurrent weblog transfers, and attempts made for each file
+FETCH_THREADS = 8
+FETCH_RETRIES = 3
+FETCH_BACKOFF = 5
+FETCH_MANIFEST = '.fetch_manifest.json'
+PART_SUFFIX = '.part'
+
+# Downloaded scene names, and the order inputs they are matched to
+LANDSAT_PRE_REGEX = re.compile(r'^(?P<sensor>L\w{2})[0-9]{6}[0-9]{7}$')
+LANDSAT_COLLECT_REGEX = re.compile(r'^(?P<sensor>L\w{3})[0-9]{6}[0-9]{8}(?P<collect>\w{4})$')
+MODIS_REGEX = re.compile(r'^(?P<sensor>M\w{6})h[0-9]{2}v[0-9]{2}[0-9]{7}(?P<collect>\w{3})$')
+VIIRS_REGEX = re.compile(r'^(?P<sensor>V\w{6})h[0-9]{2}v[0-9]{2}[0-9]{7}(?P<collect>\w{3})$')
+COLLECTION_INPUT_REGEX = re.compile(r'(.{4})_\w{4}_(.{6})_(.{8})_')
+TILE_INPUT_REGEX = re.compile(r'(.{7}).A(.{7}).(.{6})')
+LANDSAT_PRE_LENGTH = 16
+
+# Product prefix of the output file names, for each sensor key
+SENSOR_PREFIXES = {'LC8': 'olitirs8', 'LC08': 'olitirs8_collection',
+                   'LO8': 'oli8', 'LT8': 'tirs8',
+                   'LO08': 'oli8_collection', 'LT08': 'tirs8_collection',
+                   'LE7': 'etm7', 'LE07': 'etm7_collection',
+                   'LT5': 'tm5', 'LT05': 'tm5_collection',
+                   'LT4': 'tm4', 'LT04': 'tm4_collection',
+                   'MOD09A1': 'mod09a1', 'MOD09GA': 'mod09ga', 'MOD09GQ': 'mod09gq',
+                   'MOD09Q1': 'mod09q1', 'MOD13A1': 'mod13a1', 'MOD13A2': 'mod13a2',
+                   'MOD13A3': 'mod13a3', 'MOD13Q1': 'mod13q1',
+                   'MYD09A1': 'myd09a1', 'MYD09GA': 'myd09ga', 'MYD09GQ': 'myd09gq',
+                   'MYD09Q1': 'myd09q1', 'MYD13A1': 'myd13a1', 'MYD13A2': 'myd13a2',
+                   'MYD13A3': 'myd13a3', 'MYD13Q1': 'myd13q1',
+                   'VNP09GA': 'vnp09ga'}
+SENSOR_PREFIX_LENGTHS = sorted(set(len(p) for p in SENSOR_PREFIXES), reverse=True)
+# Parse caches and download records older than this are rebuilt
+CACHE_MAX_AGE_DAYS = 90
+
 EMAIL_SUBJECT = 'LSRD ESPA Metrics for {begin} to {stop}'
+# Orders listed in the downloads by order of the pandas engine
+TOP_ORDERS = 10
+# Kept month to month, away from the log directory which gets emptied
+TIMINGS_DIR = os.path.join(os.path.expanduser('~'), 'metrics-timings')
+TIMINGS_FILE = 'metrics-timings_{sensors}_{begin}_{stop}.json'
+PROFILE_FILE = 'metrics-profile_{sensors}_{begin}_{stop}'
 ORDER_SOURCES = ('ee', 'espa')
 
 SENSOR_KEYS = ('tm4', 'tm5', 'etm7', 'olitirs8', 'oli8',
@@ -36,6 +86,87 @@ SENSOR_KEYS = ('tm4', 'tm5', 'etm7', 'olitirs8', 'oli8',
                'myd13a1', 'myd13a2', 'myd13a3', 'myd13q1',
                'vnp09ga', 'invalid')
 
+# Sensor sets which can be given to --sensors by name
+SENSOR_GROUPS = OrderedDict([
+    ('ALL', tuple(k for k in SENSOR_KEYS if k != 'invalid')),
+    ('MODIS', tuple(k for k in SENSOR_KEYS if k.lower().startswith('m'))),
+    ('VIIRS', tuple(k for k in SENSOR_KEYS if k.lower().startswith('v'))),
+    ('LANDSAT', tuple(k for k in SENSOR_KEYS if k != 'invalid' and not k.lower().startswith('m')))])
+
+# Order and product counts for the monthly report (also explained by bench_db)
+# dates are given as ISO 8601 'YYYY-MM-DD', sensors as a tuple of SENSOR_KEYS
+ONDEMAND_SQL = '''select order_source,
+                      count(distinct orderid)
+                          filter (where orderid like '%%@usgs.gov-%%'),
+                      count(distinct orderid)
+                          filter (where orderid not like '%%@usgs.gov-%%'),
+                      coalesce(sum(jsonb_array_length(product_opts->sensors->'inputs'))
+                          filter (where orderid like '%%@usgs.gov-%%'), 0),
+                      coalesce(sum(jsonb_array_length(product_opts->sensors->'inputs'))
+                          filter (where orderid not like '%%@usgs.gov-%%'), 0),
+                      count(distinct email)
+                  from ordering_order
+                  left join lateral jsonb_object_keys(product_opts) sensors on True
+                  where order_date::date >= %s
+                  and order_date::date <= %s
+                  and order_source in %s
+                  and sensors in %s
+                  and product_opts->sensors ? 'inputs'
+                  group by order_source ;'''
+
+TOP10_SQL = '''select u.email, coalesce(sum(jsonb_array_length(product_opts->sensors->'inputs')),0) scenes
+               from ordering_order o
+               left join lateral jsonb_object_keys(product_opts) sensors on True
+               join auth_user u
+                    on o.user_id = u.id
+               where o.order_date::date >= %s
+               and o.order_date::date <= %s
+               and sensors in %s
+               and product_opts->sensors ? 'inputs'
+               group by u.email
+               order by scenes desc
+               limit 10'''
+
+PRODINFO_SQL = '''with sensor_inputs as (
+                      select product_opts opts, sensors sensor,
+                             jsonb_array_length(product_opts->sensors->'inputs') n
+                      from ordering_order
+                      join lateral jsonb_object_keys(product_opts) sensors on True
+                      where order_date::date >= %s
+                      and order_date::date <= %s
+                      and sensors in %s
+                      and product_opts->sensors ? 'inputs')
+                  select 'total', coalesce(sum(n), 0)
+                  from sensor_inputs
+                  union all
+                  select 'plot_statistics', coalesce(sum(n), 0)
+                  from sensor_inputs
+                  -- same truthiness as python gives the option
+                  where coalesce(opts->>'plot_statistics', 'false')
+                        not in ('false', '0', '', '[]', '{}')
+                  union all
+                  select case when p.prod = 'l1' and (s.opts ? 'projection' or
+                                                      s.opts ? 'image_extents')
+                              then 'customized_source_data'
+                              else p.prod end,
+                         sum(s.n)
+                  from sensor_inputs s
+                  cross join lateral jsonb_array_elements_text(s.opts->s.sensor->'products') p(prod)
+                  group by 1 ;'''
+
+# One row per order, without grouping (sorting) on the product_opts blobs
+PRODOPTS_SQL = ('SELECT product_opts '
+                'FROM ordering_order '
+                'WHERE order_date::date >= %s '
+                'AND order_date::date <= %s '
+                'AND exists (select 1 from jsonb_object_keys(product_opts) sensors '
+                'where sensors in %s '
+                "and product_opts->sensors ? 'inputs')")
+
+DL_PRODINFO_SQL = ('SELECT o.orderid, o.product_opts '
+                   'FROM ordering_order o '
+                   'WHERE o.orderid = ANY (%s)')
+
 
 def arg_parser(defaults):
     """
@@ -67,6 +198,39 @@ def arg_parser(defaults):
     parser.add_argument('--plotting', dest='plotting',
                         action='store_true',
                         help='Also generate plots')
+    parser.add_argument('-w', '--workers', dest='workers', type=int,
+                        default=defaults['workers'],
+                        help='Number of processes used to parse the logs [%s]'
+                        % defaults['workers'])
+    parser.add_argument('--no_cache', dest='cache', action='store_false',
+                        help='Re-parse every log, ignoring cached results')
+    parser.add_argument('--cache_days', dest='cache_days', type=int,
+                        default=defaults['cache_days'],
+                        help='Remove parse caches older than this many days [%s]'
+                        % defaults['cache_days'])
+    parser.add_argument('--reader', dest='reader',
+                        choices=weblogs.READERS, default=defaults['reader'],
+                        help='How to decompress the logs [%s]'
+                        % defaults['reader'])
+    parser.add_argument('--engine', dest='engine',
+                        choices=('logs', 'records', 'pandas'),
+                        default=defaults['engine'],
+                        help='Count downloads from the log summaries, or keep '
+                             'and count the columnar download records, with '
+                             'numpy or pandas [%s]'
+                        % defaults['engine'])
+    parser.add_argument('--fetch_threads', dest='fetch_threads', type=int,
+                        default=defaults['fetch_threads'],
+                        help='Number of logs to download at once [%s]'
+                        % defaults['fetch_threads'])
+    parser.add_argument('--cross_check', dest='cross_check', action='store_true',
+                        help='Verify the database product counts against python')
+    parser.add_argument('--profile', dest='profile', action='store_true',
+                        help='Profile the run with cProfile, written to the timings directory')
+    parser.add_argument('--timings_dir', dest='timings_dir',
+                        default=defaults['timings_dir'],
+                        help='Directory to keep the run timings and profiles in [%s]'
+                        % defaults['timings_dir'])
 
     args = parser.parse_args()
     defaults.update(args.__dict__)
@@ -95,6 +259,51 @@ def download_boiler(info):
     return boiler.format(**info)
 
 
+def download_breakdown_boiler(info):
+    """
+    Boiler plate text for the downloads by sensor and by order,
+    only counted by the pandas engine (see frame_dlinfo)
+
+    :param info: values to insert into the boiler plate
+    :param info: dict
+    :return: formatted string
+    """
+    bytes_in_a_gb = 1073741824.0
+    boiler = ('\n==========================================\n'
+              ' On-demand - Downloads by Sensor\n'
+              '==========================================\n')
+    for sensor, row in info['by_sensor'].iterrows():
+        boiler += ' {}: {} ({:.2f} GB)\n'.format(sensor, row['downloads'],
+                                                 row['bytes'] / bytes_in_a_gb)
+
+    by_order = info['by_order'].sort_values(['bytes', 'downloads'], ascending=False)
+    boiler += ('\n==========================================\n'
+               ' On-demand - Downloads by Order\n'
+               '==========================================\n'
+               ' Orders downloaded from: {}\n'.format(len(by_order)))
+    for orderid, row in by_order.head(TOP_ORDERS).iterrows():
+        boiler += ' {}: {} downloads of {} scenes ({:.2f} GB)\n'.format(
+            orderid, row['downloads'], row['scenes'], row['bytes'] / bytes_in_a_gb)
+
+    return boiler
+
+
+def timing_boiler(info):
+    """
+    Boiler plate text for the run timings
+
+    :param info: run summary, see profiling.summary
+    :param info: dict
+    :return: formatted string
+    """
+    boiler = ('\n==========================================\n'
+              ' Run Timings\n'
+              '==========================================\n'
+              '{}\n')
+
+    return boiler.format(json.dumps(info, indent=2))
+
+
 def ondemand_boiler(info):
     """
     Boiler plate text for On-Demand Info for orders
@@ -188,11 +397,14 @@ def top_users_boiler(info):
     return boiler.format(*info)
 
 
-def db_prodinfo(dbinfo, begin_date, end_date, sensors):
+def db_prodinfo(dbinfo, begin_date, end_date, sensors, cross_check=False):
     """
     Queries the database to build the ordered product counts
     dates are given as ISO 8601 'YYYY-MM-DD'
 
+    The counts are tallied by postgres, with cross_check they are
+    also tallied in python from the raw product options and compared
+
     :param dbinfo: Database connection information
     :type dbinfo: dict
     :param begin_date: Date to start the counts on
@@ -201,30 +413,66 @@ def db_prodinfo(dbinfo, begin_date, end_date, sensors):
     :type end_date: str
     :param sensors: which sensors to process (['tm4','etm7',...])
     :type sensors: tuple
+    :param cross_check: verify the counts against db_prodinfo_python
+    :type cross_check: bool
     :return: Dictionary of count values
     """
-    sql = ('SELECT product_opts '
-           'FROM ordering_order '
-           'left join lateral jsonb_object_keys(product_opts) sensors on True '
-           'WHERE order_date::date >= %s '
-           'AND order_date::date <= %s '
-           'AND sensors in %s '
-           "and product_opts->sensors ? 'inputs' "
-           "group by product_opts, id")
+    with DBConnect(**dbinfo) as db:
+        db.select(PRODINFO_SQL, (begin_date, end_date, sensors))
+        results = {prod: int(count) for prod, count in db}
 
-    init = {'total': 0}
+    if cross_check:
+        check = db_prodinfo_python(dbinfo, begin_date, end_date, sensors)
+        for prod in sorted(set(results) | set(check)):
+            if prod != 'title' and results.get(prod, 0) != check.get(prod, 0):
+                logger.warning('! Product count mismatch for {}: SQL {} != python {}'
+                               .format(prod, results.get(prod, 0), check.get(prod, 0)))
 
+    results['title'] = 'What was Ordered'
+    return results
+
+
+def db_prodinfo_python(dbinfo, begin_date, end_date, sensors):
+    """
+    Queries the database for the product options of every order and
+    builds the ordered product counts in python, see db_prodinfo
+    dates are given as ISO 8601 'YYYY-MM-DD'
+
+    :param dbinfo: Database connection information
+    :type dbinfo: dict
+    :param begin_date: Date to start the counts on
+    :type begin_date: str
+    :param end_date: Date to end the counts on
+    :type end_date: str
+    :param sensors: which sensors to process (['tm4','etm7',...])
+    :type sensors: tuple
+    :return: Dictionary of count values
+    """
+    results = defaultdict(int)
+    results['total'] = 0
+
+    # Orders are streamed and tallied one at a time, keeping memory flat
     with DBConnect(**dbinfo) as db:
-        db.select(sql, (begin_date, end_date, sensors))
-        results = reduce(counts_prodopts, [process_db_prodopts(r, sensors) for r in db.fetcharr], init)
+        for row in db.stream(PRODOPTS_SQL, (begin_date, end_date, sensors)):
+            process_db_prodopts(row, sensors, results)
 
+    results = dict(results)
     results['title'] = 'What was Ordered'
     return results
 
 
-def process_db_prodopts(row, sensors=SENSOR_KEYS):
-    ret = defaultdict(int)
-    # ret = {'total': 0}
+def process_db_prodopts(row, sensors=SENSOR_KEYS, ret=None):
+    """
+    Count the ordered scenes per product for a single order
+
+    :param row: database row holding the order product options
+    :param sensors: which sensors to count
+    :param ret: running counts to add to, a new one is made if not given
+    :type ret: defaultdict(int)
+    :return: the counts
+    """
+    if ret is None:
+        ret = defaultdict(int)
     opts = row[0]
 
     for key in sensors:
@@ -270,12 +518,8 @@ def db_dl_prodinfo(dbinfo, orders_scenes):
     ids = zip(*orders_scenes)[0]
     ids = remove_duplicates(ids)
 
-    sql = ('SELECT o.orderid, o.product_opts '
-           'FROM ordering_order o '
-           'WHERE o.orderid = ANY (%s)')
-
     with DBConnect(**dbinfo) as db:
-        db.select(sql, (ids, ))
+        db.select(DL_PRODINFO_SQL, (ids, ))
         results = {k: val for k, val in db.fetcharr}
 
     return results
@@ -293,10 +537,8 @@ def landsat_output_regex(filename):
     """
     fname = os.path.basename(filename)
     sceneid = fname.split('-')[0]
-    regex_pre = '^(?P<sensor>L\w{2})[0-9]{6}[0-9]{7}$'
-    regex_collect = '^(?P<sensor>L\w{3})[0-9]{6}[0-9]{8}(?P<collect>\w{4})$'
-    for regex in [regex_pre, regex_collect]:
-        res = re.match(regex, sceneid)
+    for regex in [LANDSAT_PRE_REGEX, LANDSAT_COLLECT_REGEX]:
+        res = regex.match(sceneid)
         if res:
             return res.groupdict()
 
@@ -309,8 +551,7 @@ def modis_output_regex(filename):
     """
     fname = os.path.basename(filename)
     sceneid = fname.split('-')[0]
-    regex = '^(?P<sensor>M\w{6})h[0-9]{2}v[0-9]{2}[0-9]{7}(?P<collect>\w{3})$'
-    res = re.match(regex, sceneid)
+    res = MODIS_REGEX.match(sceneid)
     if res:
         return res.groupdict()
 
@@ -323,12 +564,66 @@ def viirs_output_regex(filename):
     """
     fname = os.path.basename(filename)
     sceneid = fname.split('-')[0]
-    regex = '^(?P<sensor>V\w{6})h[0-9]{2}v[0-9]{2}[0-9]{7}(?P<collect>\w{3})$'
-    res = re.match(regex, sceneid)
+    res = VIIRS_REGEX.match(sceneid)
     if res:
         return res.groupdict()
 
 
+def scene_key(scene):
+    """
+    Normalize a downloaded scene name into the key its order input
+    is indexed under (see build_scene_index)
+
+    Landsat collection: LE070430332014070901T1 -> LE07_xxxx_043033_20140709_
+    Landsat pre-collection: LT50310341990240 -> any input containing it
+    MODIS/VIIRS: MOD09A1h10v042016001006 -> MOD09A1.A2016001.h10v04
+
+    :param scene: scene name from the download file name
+    :return: key tuple, or None when the inputs have to be searched
+        (unrecognized names)
+    """
+    info = landsat_output_regex(scene)
+    if info:
+        if 'collect' in info:
+            return 'collection', scene[0:4], scene[4:10], scene[10:18]
+        # Scene names get truncated during distribution
+        return 'substring', scene
+
+    if modis_output_regex(scene) or viirs_output_regex(scene):
+        return 'tile', scene[0:7], scene[13:20], scene[7:13]
+
+
+def build_scene_index(opts):
+    """
+    Index the inputs of an order by the keys scene_key gives
+    the downloaded scenes.  For pre-collection scene ids every 16
+    character window of the input is indexed, so a scene id matches
+    wherever it appears in the input name, as the substring search did
+
+    :param opts: product options of the order
+    :type opts: dict
+    :return: dict of key: set of sensor keys holding a matching input
+    """
+    index = defaultdict(set)
+    for key in SENSOR_KEYS:
+        if key not in opts:
+            continue
+        for x in opts[key]['inputs']:
+            res = COLLECTION_INPUT_REGEX.match(x)
+            if res:
+                index[('collection', ) + res.groups()].add(key)
+            res = TILE_INPUT_REGEX.match(x)
+            if res:
+                index[('tile', ) + res.groups()].add(key)
+            # pre-collection scene ids all start with L
+            i = x.find('L')
+            while 0 <= i <= len(x) - LANDSAT_PRE_LENGTH:
+                index[('substring', x[i:i + LANDSAT_PRE_LENGTH])].add(key)
+                i = x.find('L', i + 1)
+
+    return index
+
+
 def tally_product_dls(orders_scenes, prod_options):
     """
     Counts the number of times a product has been downloaded
@@ -342,6 +637,7 @@ def tally_product_dls(orders_scenes, prod_options):
     :return: dictionary count
     """
     results = defaultdict(int)
+    indexes = {}
 
     for orderid, scene in orders_scenes:
         oid = urllib2.unquote(orderid)
@@ -350,33 +646,22 @@ def tally_product_dls(orders_scenes, prod_options):
             continue
 
         opts = prod_options[oid]
+        if oid not in indexes:
+            indexes[oid] = build_scene_index(opts)
+        index = indexes[oid]
 
         if 'plot_statistics' in opts and opts['plot_statistics']:
             results['plot_statistics'] += 1
 
+        skey = scene_key(scene)
+        matched = index.get(skey, ()) if skey is not None else None
+
         for key in SENSOR_KEYS:
             if key in opts:
-                # Scene names get truncated during distribution
-                res = [x for x in opts[key]['inputs'] if scene in x]
-
-                info = landsat_output_regex(scene)
-                if info:
-                    if 'collect' in info: # This is a landsat collection scene
-                        # scene = LE070430332014070901T1, x = LE07_L1TP_043033_20140709_20160909_01_T1
-                        # scene_regex = 'LE07_\\w{4}_043033_20140709_'
-                        scene_regex = scene[0:4] + '_\w{4}_' + scene[4:10] + '_' + scene[10:18] + '_'
-                        res = [x for x in opts[key]['inputs'] if re.match(scene_regex, x)]
+                if matched is not None:
+                    res = key in matched
                 else:
-                    info = modis_output_regex(scene)
-                    if info:
-                        scene_regex = scene[0:7] + '.A' + scene[13:20] + '.' + scene[7:13]
-                        res = [x for x in opts[key]['inputs'] if re.match(scene_regex, x)]
-
-                    else:
-                        info = viirs_output_regex(scene)
-                        if info:
-                            scene_regex = scene[0:7] + '.A' + scene[13:20] + '.' + scene[7:13]
-                            res = [x for x in opts[key]['inputs'] if re.match(scene_regex, x)]
+                    res = any(scene in x for x in opts[key]['inputs'])
 
                 if res:
                     results['total'] += 1
@@ -392,7 +677,71 @@ def tally_product_dls(orders_scenes, prod_options):
     return results
 
 
-def calc_dlinfo(log_glob, start_date, end_date, sensors):
+def parse_log_file(args):
+    """
+    Count the tarballs downloaded from /orders/ in a single log file
+
+    Arguments come packed in a single tuple so this can be handed
+    straight to a multiprocessing pool
+
+    :param args: (log_file, start_date, end_date, sensors, use_cache, reader,
+        engine), with the 'records' and 'pandas' engines the downloads are
+        counted from the download records of the log (see calc_dlinfo)
+    :type args: tuple
+    :return: downloads, volume (bytes), set of order paths, dict of
+        the parse counters (see weblogs.summarize_log), and with the
+        'pandas' engine the downloads by sensor and by order (None otherwise)
+    """
+    log_file, start_date, end_date, sensors, use_cache, reader, engine = args
+    tot_dl, tot_vol = 0, 0
+    order_paths = set()
+    stats = {'log_bytes': os.path.getsize(log_file)}
+    records = engine in ('records', 'pandas')
+
+    if records:
+        summary = None
+        cached = use_cache and weblogs.records_current(log_file)
+    else:
+        summary = weblogs.load_summary(log_file) if use_cache else None
+        cached = summary is not None
+    if not cached:
+        print('* Parse: {}'.format(log_file))
+        summary = weblogs.summarize_log(log_file, reader, records, stats)
+        stats['logs_parsed'] = 1
+        if use_cache:
+            weblogs.save_summary(log_file, summary)
+    else:
+        print('* Cached: {}'.format(log_file))
+        stats['logs_cached'] = 1
+
+    if engine == 'records':
+        part = records_dlinfo(weblogs.read_records([log_file], start_date, end_date),
+                              sensors)
+        return part + (stats, None)
+    elif engine == 'pandas':
+        info = frame_dlinfo(records_frame(weblogs.read_records([log_file], start_date,
+                                                               end_date)), sensors)
+        return (info['tot_dl'], info['tot_vol'], info['order_paths'], stats,
+                (info['by_sensor'], info['by_order']))
+
+    first_day, last_day = start_date.toordinal(), end_date.toordinal()
+    for day, resources in summary.items():
+        if not first_day <= day <= last_day:
+            continue
+        for resource, (downloads, volume) in resources.items():
+            if get_sensor_name(resource) not in sensors:
+                # Difficult to say if statistics should be counted...
+                # if not resource.endswith('statistics.tar.gz'):
+                continue
+            tot_vol += volume
+            tot_dl += downloads
+            order_paths.add(resource)
+
+    return tot_dl, tot_vol, order_paths, stats, None
+
+
+def calc_dlinfo(log_glob, start_date, end_date, sensors, workers=1,
+                use_cache=True, reader='auto', engine='logs'):
     """
     Count the total tarballs downloaded from /orders/ and their combined size
 
@@ -404,6 +753,17 @@ def calc_dlinfo(log_glob, start_date, end_date, sensors):
     :type end_date: datetime.date
     :param sensors: which sensors to process (['tm4','etm7',...])
     :type sensors: tuple
+    :param workers: number of processes to parse the log files with
+    :type workers: int
+    :param use_cache: reuse (and store) the per log file parse results
+    :type use_cache: bool
+    :param reader: how to decompress the logs (weblogs.READERS)
+    :type reader: str
+    :param engine: 'logs' to count from the per log summaries, 'records'
+        to also keep every download record and count from those, 'pandas'
+        to count the records with pandas, also breaking the downloads
+        down by sensor and by order (see frame_dlinfo)
+    :type engine: str
     :return: Dictionary of values
     """
     infodict = {'tot_dl': 0,
@@ -417,168 +777,235 @@ def calc_dlinfo(log_glob, start_date, end_date, sensors):
     if len(files) < 1:
         raise RuntimeError('No files found in date range: %s' % log_glob)
 
+    reader = weblogs.find_reader(reader)
+    jobs = [(log_file, start_date, end_date, sensors, use_cache, reader, engine)
+            for log_file in sorted(files)]
+
+    if workers > 1 and len(jobs) > 1:
+        pool = mp.Pool(processes=min(workers, len(jobs)))
+        try:
+            # map() hands the results back in job order, which keeps
+            # the merge below independent of worker scheduling
+            parsed = pool.map(parse_log_file, jobs, chunksize=1)
+        except Exception:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+    else:
+        parsed = map(parse_log_file, jobs)
+
+    for stats in (p[3] for p in parsed):
+        for key, value in sorted(stats.items()):
+            profiling.count(key, value)
+    partials = [p[:3] for p in parsed]
+
+    tot_vol = 0
     order_paths = set()
-    for log_file in files:
-        print('* Parse: {}'.format(log_file))
-        with gzip.open(log_file) as log:
-            for line in log:
-                gr = filter_log_line(line, start_date, end_date)
-                if gr:
-                    if get_sensor_name(gr['resource']) not in sensors:
-                        # Difficult to say if statistics should be counted...
-                        # if not gr['resource'].endswith('statistics.tar.gz'):
-                        continue
-                    infodict['tot_vol'] += int(gr['size'])
-                    infodict['tot_dl'] += 1
-                    order_paths.add(gr['resource'])
+    for part_dl, part_vol, part_paths in partials:
+        infodict['tot_dl'] += part_dl
+        tot_vol += part_vol
+        order_paths.update(part_paths)
 
     # Bytes to GB
-    infodict['tot_vol'] /= bytes_in_a_gb
+    infodict['tot_vol'] = tot_vol / bytes_in_a_gb
 
-    return infodict, list(order_paths)
+    breakdowns = [p[4] for p in parsed if p[4] is not None]
+    if breakdowns:
+        infodict.update(merge_breakdowns(breakdowns, order_paths))
+
+    return infodict, sorted(order_paths)
+
+
+def records_dlinfo(records, sensors):
+    """
+    Count the tarballs downloaded from columnar download records,
+    the same way parse_log_file does from a log summary
+
+    :param records: download records, as from weblogs.read_records
+    :type records: dict
+    :param sensors: which sensors to process (['tm4','etm7',...])
+    :type sensors: tuple
+    :return: downloads, volume (bytes), set of order paths
+    """
+    resources = records['resource_values']
+    wanted = np.array([s in sensors for s in classify_many(list(resources))],
+                      dtype=bool)
+    keep = wanted[records['resource']] if len(resources) else wanted[:0]
+
+    tot_dl = int(keep.sum())
+    tot_vol = int(records['size'][keep].sum())
+    order_paths = set(resources[np.unique(records['resource'][keep])])
+
+    return tot_dl, tot_vol, order_paths
+
+
+def records_frame(records):
+    """
+    Load columnar download records into a DataFrame, the dictionary
+    encoded strings becoming categoricals
+
+    pandas is only imported here, it is not needed by the other engines
+
+    :param records: download records, as from weblogs.read_records
+    :type records: dict
+    :return: pandas.DataFrame
+    """
+    import pandas as pd
+
+    frame = pd.DataFrame({k: records[k] for k in ('day', 'second', 'status', 'size')},
+                         columns=['day', 'second', 'status', 'size'])
+    for name in weblogs.RECORD_STRINGS:
+        frame[name] = pd.Categorical.from_codes(records[name].astype(np.int64),
+                                                records[name + '_values'])
+    return frame
+
+
+def frame_dlinfo(frame, sensors):
+    """
+    Count the tarballs downloaded from a DataFrame of download records,
+    giving the same totals as parse_log_file and extract_orderid
+
+    String work is only done once per distinct resource, and mapped
+    back onto the downloads through the categorical codes
+
+    :param frame: download records, as from records_frame
+    :type frame: pandas.DataFrame
+    :param sensors: which sensors to process (['tm4','etm7',...])
+    :type sensors: tuple
+    :return: dict of tot_dl, tot_vol (bytes), order_paths (set), by_sensor
+        and by_order (DataFrames of downloads and bytes, by_order also
+        counting the distinct scenes)
+    """
+    import pandas as pd
+
+    resources = pd.Series(frame['resource'].cat.categories, dtype=object)
+    orderids, scenes = order_scenes(resources)
+    codes = frame['resource'].cat.codes.values
+
+    downloads = pd.DataFrame({
+        'size': frame['size'].values,
+        'sensor': np.array(classify_many(list(resources)), dtype=object)[codes],
+        'orderid': orderids.values[codes],
+        'scene': scenes.values[codes],
+        'resource': codes})
+    downloads = downloads[downloads['sensor'].isin(sensors)]
+
+    by_sensor = (downloads.groupby('sensor')['size'].agg(['count', 'sum'])
+                 .rename(columns={'count': 'downloads', 'sum': 'bytes'}))
+    orders = downloads.groupby('orderid')
+    by_order = (orders['size'].agg(['count', 'sum'])
+                .rename(columns={'count': 'downloads', 'sum': 'bytes'}))
+    by_order['scenes'] = orders['scene'].nunique()
+
+    return {'tot_dl': len(downloads),
+            'tot_vol': int(downloads['size'].sum()),
+            'order_paths': set(resources.values[downloads['resource'].unique()]),
+            'by_sensor': by_sensor,
+            'by_order': by_order}
+
+
+def order_scenes(resources):
+    """
+    Split download paths, /orders/<orderid>/<scene>-<product>.tar.gz,
+    into their order and scene ids
+
+    :param resources: download paths
+    :type resources: pandas.Series
+    :return: Series of order ids, Series of scene ids
+    """
+    parts = resources.str.split('/')
+    return parts.str[2], parts.str[3].str.split('-').str[0]
+
+
+def merge_breakdowns(breakdowns, order_paths):
+    """
+    Add up the downloads by sensor and by order of several log files
+
+    The distinct scenes of an order can not be added up across files,
+    they are counted again from the order paths of all the files
+
+    :param breakdowns: (by_sensor, by_order) of each file, see frame_dlinfo
+    :type breakdowns: list
+    :param order_paths: paths downloaded from all the files
+    :type order_paths: set
+    :return: dict of by_sensor and by_order
+    """
+    import pandas as pd
+
+    by_sensor = pd.concat([s for s, _ in breakdowns]).groupby(level=0).sum()
+    by_order = (pd.concat([o[['downloads', 'bytes']] for _, o in breakdowns])
+                .groupby(level=0).sum())
+    orderids, scenes = order_scenes(pd.Series(sorted(order_paths), dtype=object))
+    by_order['scenes'] = scenes.groupby(orderids.values).nunique()
+
+    return {'by_sensor': by_sensor, 'by_order': by_order}
 
 
 def filter_log_line(line, start_date, end_date):
     """
     Used to determine if a line in the log should be used for metrics
-    counting
+    counting, see weblogs.LogMatcher.match
 
-    Filters to make sure the line follows a regex
-    HTTP response is a 200
-    HTTP method is a GET
-    location is from /orders/
-    falls within the date range
+    Builds a new matcher on every call, use a weblogs.LogMatcher
+    directly when filtering a whole file
 
     :param line: incoming line from the log
     :param start_date: inclusive start date
     :param end_date: inclusive end date
     :return: regex groups returned from re.match
     """
-    # Leaving the old nginx log output style for previous months
-    regexs = [(r'(?P<ip>.*?) - \[(?P<datetime>.*?)\] "(?P<method>.*?) (?P<resource>.*?) (?P<protocol>.*?)" '
-              r'(?P<status>\d+) (?P<len>\d+) (?P<range>.*?) (?P<size>\d+) \[(?P<reqtime>\d+\.\d+)\] "(?P<referrer>.*?)" '
-              r'"(?P<agent>.*?)"'),
-              (r'(?P<ip>.*?) (?P<logname>.*?) (?P<user>.*?) \[(?P<datetime>.*?)\] "(?P<method>.*?) (?P<resource>.*?) '
-              r'(?P<status>\d+)" (?P<size>\d+) (?P<referrer>\d+) "(?P<agent>.*?)" "(?P<extra>.*?)"'),
-             (r'(?P<ip>[0-9\.]*) .* \[(?P<datetime>.*)\] \"(?P<method>[A-Z]*) (?P<resource>.*) '
-               r'(?P<protocol>.*)\" (?P<status>\d+) (?P<size>\d+) "(?P<referrer>.*?)" "(?P<agent>.*)"'),
-              (r'(?P<ip>[0-9\.]*) .* \[(?P<datetime>.*)\] "(?P<method>[A-Z]*) (?P<resource>.*) (?P<protocol>.*)" '
-               r'(?P<status>\d+) (?P<len>\d+) (?P<range>.*) (?P<size>\d+) \[(?P<reqtime>\d+\.\d+)\] "(?P<referrer>.*)" '
-               r'"(?P<agent>.*)"')
-              ]
-
-    if ('tar.gz' in line) and ('GET' in line):
-        for regex in regexs:
-            res = re.match(regex, line)
-            if res:
-                break
-        if res:
-            gr = res.groupdict()
-            ts, tz = gr['datetime'].split()
-            dt = datetime.datetime.strptime(ts, r'%d/%b/%Y:%H:%M:%S').date()
+    return weblogs.LogMatcher(start_date, end_date).match(line)
 
-            if ((gr['status'] in ['200', '206']) and
-                    gr['method'] == 'GET' and
-                    '.tar.gz' in gr['resource'] and
-                    '/orders/' in gr['resource'] and
-                    start_date <= dt <= end_date):
 
-                return gr
-        else:
-            #raise ValueError('! Unable to parse download line: \n\t{}'.format(line))
-            print('!'*50 + '\nUnable to parse download line: \n\t{}'.format(line))
+def sensor_label(sensors):
+    """
+    Name of a set of sensors for the files of a run, the SENSOR_GROUPS
+    name it matches or the sensors themselves
 
-    return False
+    :param sensors: which sensors are processed (['tm4','etm7',...])
+    :return: str
+    """
+    for name, group in SENSOR_GROUPS.items():
+        if tuple(sensors) == group:
+            return name
+    return '-'.join(sensors)
 
 
 def get_sensor_name(filename):
     """
     Converts a filename into a sensor key (SENSOR_KEYS)
+    The longest matching product prefix wins, so LC08 is never taken for LC8
     :param filename: product output path [/orders/<oid>/<prod>-<time>.tar.gz]
     :return: str
     """
-    lut = {'LC8': 'olitirs8', 'LC08': 'olitirs8_collection',
-           'LO8': 'oli8', 'LT8': 'tirs8',
-           'LO08': 'oli8_collection', 'LT08': 'tirs8_collection',
-           'LE7': 'etm7', 'LE07': 'etm7_collection',
-           'LT5': 'tm5', 'LT05': 'tm5_collection',
-           'LT4': 'tm4', 'LT04': 'tm4_collection',
-           'MOD09A1': 'mod09a1', 'MOD09GA': 'mod09ga', 'MOD09GQ': 'mod09gq',
-           'MOD09Q1': 'mod09q1', 'MOD13A1': 'mod13a1', 'MOD13A2': 'mod13a2',
-           'MOD13A3': 'mod13a3', 'MOD13Q1': 'mod13q1',
-           'MYD09A1': 'myd09a1', 'MYD09GA': 'myd09ga', 'MYD09GQ': 'myd09gq',
-           'MYD09Q1': 'myd09q1', 'MYD13A1': 'myd13a1', 'MYD13A2': 'myd13a2',
-           'MYD13A3': 'myd13a3', 'MYD13Q1': 'myd13q1',
-           'VNP09GA': 'vnp09ga'}
     fname = os.path.basename(filename)
-    for prefix, sensor in lut.iteritems():
-        if fname.startswith(prefix):
+    for length in SENSOR_PREFIX_LENGTHS:
+        sensor = SENSOR_PREFIXES.get(fname[:length])
+        if sensor is not None:
             return sensor
 
 
-def db_scenestats(source, begin_date, end_date, sensors, dbinfo):
+def classify_many(filenames):
     """
-    Queries the database for the number of scenes ordered
-    separated by USGS and non-USGS emails
-    dates are given as ISO 8601 'YYYY-MM-DD'
-
-    :param source: EE or ESPA
-    :type source: str
-    :param begin_date: Date to start the count on
-    :type begin_date: str
-    :param end_date: Date to stop the count on
-    :type end_date: str
-    :param sensors: which sensors to process (['tm4', 'etm7', ...])
-    :type sensors: tuple
-    :param dbinfo: Database connection information
-    :type dbinfo: dict
-    :return: Dictionary of the counts
-    """
-    sql = ('''select coalesce(sum(jsonb_array_length(product_opts->sensors->'inputs')),0)
-              from ordering_order
-              left join lateral jsonb_object_keys(product_opts) sensors on True
-              where ordering_order.order_date::date >= %s
-              and ordering_order.order_date::date <= %s
-              and ordering_order.orderid like '%%@usgs.gov-%%'
-              and ordering_order.order_source = %s
-              and sensors in %s
-              and product_opts->sensors ? 'inputs' ''',
-           '''select coalesce(sum(jsonb_array_length(product_opts->sensors->'inputs')),0)
-              from ordering_order
-              left join lateral jsonb_object_keys(product_opts) sensors on True
-              where ordering_order.order_date::date >= %s
-              and ordering_order.order_date::date <= %s
-              and ordering_order.orderid not like '%%@usgs.gov-%%'
-              and ordering_order.order_source = %s
-              and sensors in %s
-              and product_opts->sensors ? 'inputs' ''')
-
-    counts = {'scenes_month': 0,
-              'scenes_usgs': 0,
-              'scenes_non': 0}
-
-    with DBConnect(**dbinfo) as db:
-        for q in sql:
-            db.select(q, (begin_date, end_date, source, sensors))
-
-            if 'not like' in q:
-                counts['scenes_non'] += int(db[0][0])
-            else:
-                counts['scenes_usgs'] += int(db[0][0])
-
-    counts['scenes_month'] = counts['scenes_usgs'] + counts['scenes_non']
-
-    return counts
+    Converts many filenames into sensor keys, classifying each distinct
+    filename only once
+    :param filenames: product output paths
+    :return: list of str, in the same order
+    """
+    sensors = {f: get_sensor_name(f) for f in set(filenames)}
+    return [sensors[f] for f in filenames]
 
 
-def db_orderstats(source, begin_date, end_date, sensors, dbinfo):
+def db_ondemand_stats(begin_date, end_date, sensors, dbinfo, sources=ORDER_SOURCES):
     """
-    Queries the database to get the total number of orders
-    separated by USGS and non-USGS emails
+    Queries the database for the number of orders, scenes and unique users
+    per order source, with orders and scenes separated by USGS and non-USGS
+    emails, all in a single scan of the orders
     dates are given as ISO 8601 'YYYY-MM-DD'
 
-    :param source: EE or ESPA
-    :type source: str
     :param begin_date: Date to start the count on
     :type begin_date: str
     :param end_date: Date to stop the count on
@@ -587,76 +1014,25 @@ def db_orderstats(source, begin_date, end_date, sensors, dbinfo):
     :type sensors: tuple
     :param dbinfo: Database connection information
     :type dbinfo: dict
-    :return: Dictionary of the counts
-    """
-    sql = ('''select COUNT(distinct orderid)
-              from ordering_order
-              left join lateral jsonb_object_keys(product_opts) sensors on True
-              where order_date::date >= %s
-              and order_date::date <= %s
-              and orderid like '%%@usgs.gov-%%'
-              and order_source = %s
-              and sensors in %s
-              and product_opts->sensors ? 'inputs' ;''',
-           '''select COUNT(distinct orderid)
-              from ordering_order
-              left join lateral jsonb_object_keys(product_opts) sensors on True
-              where order_date::date >= %s
-              and order_date::date <= %s
-              and orderid not like '%%@usgs.gov-%%'
-              and order_source = %s
-              and sensors in %s
-              and product_opts->sensors ? 'inputs' ;''')
-
-    counts = {'orders_month': 0,
-              'orders_usgs': 0,
-              'orders_non': 0}
+    :param sources: order sources to count (ee, espa)
+    :type sources: tuple
+    :return: Dictionary of the counts, keyed on source
+    """
+    fields = ('orders_usgs', 'orders_non', 'scenes_usgs', 'scenes_non', 'tot_unique')
+    counts = {source: dict.fromkeys(fields, 0) for source in sources}
 
     with DBConnect(**dbinfo) as db:
-        for q in sql:
-            db.select(q, (begin_date, end_date, source, sensors))
+        db.select(ONDEMAND_SQL, (begin_date, end_date, tuple(sources), sensors))
+        for row in db:
+            counts[row[0]] = dict(zip(fields, [int(v) for v in row[1:]]))
 
-            if 'not like' in q:
-                counts['orders_non'] += int(db[0][0])
-            else:
-                counts['orders_usgs'] += int(db[0][0])
-
-    counts['orders_month'] = counts['orders_usgs'] + counts['orders_non']
+    for info in counts.values():
+        info['orders_month'] = info['orders_usgs'] + info['orders_non']
+        info['scenes_month'] = info['scenes_usgs'] + info['scenes_non']
 
     return counts
 
 
-def db_uniquestats(source, begin_date, end_date, sensors, dbinfo):
-    """
-    Queries the database to get the total number of unique users
-    dates are given as ISO 8601 'YYYY-MM-DD'
-
-    :param source: EE or ESPA
-    :type source: str
-    :param begin_date: Date to start the count on
-    :type begin_date: str
-    :param end_date: Date to stop the count on
-    :type end_date: str
-    :param sensors: which sensor types to process (['tm4', 'etm7',...])
-    :type sensors: tuple
-    :param dbinfo: Database connection information
-    :type dbinfo: dict
-    :return: Dictionary of the count
-    """
-    sql = '''select count(distinct(email))
-             from ordering_order
-             left join lateral jsonb_object_keys(product_opts) sensors on True
-             where order_date::date >= %s
-             and order_date::date <= %s
-             and order_source = %s
-             and sensors in %s
-             and product_opts->sensors ? 'inputs' ;'''
-
-    with DBConnect(**dbinfo) as db:
-        db.select(sql, (begin_date, end_date, source, sensors))
-        return db[0][0]
-
-
 def db_top10stats(begin_date, end_date, sensors, dbinfo):
     """
     Queries the database to get the total number of unique users
@@ -674,21 +1050,8 @@ def db_top10stats(begin_date, end_date, sensors, dbinfo):
     :type dbinfo: dict
     :return: Dictionary of the count
     """
-    sql = '''select u.email, coalesce(sum(jsonb_array_length(product_opts->sensors->'inputs')),0) scenes
-             from ordering_order o
-             left join lateral jsonb_object_keys(product_opts) sensors on True
-             join auth_user u
-                  on o.user_id = u.id
-             where o.order_date::date >= %s
-             and o.order_date::date <= %s
-             and sensors in %s
-             and product_opts->sensors ? 'inputs'
-             group by u.email
-             order by scenes desc
-             limit 10'''
-
     with DBConnect(**dbinfo) as db:
-        db.select(sql, (begin_date, end_date, sensors))
+        db.select(TOP10_SQL, (begin_date, end_date, sensors))
         return db[:]
 
 
@@ -738,40 +1101,188 @@ def extract_orderid(order_paths):
                  [i.split('/') for i in order_paths])
 
 
-def fetch_web_logs(dbconfig, env, outdir, begin, stop):
+def plan_transfer(manifest, local_path, size, mtime):
+    """
+    Decide whether, and from where, a log has to be downloaded
+
+    :param manifest: record of the previous transfers
+    :type manifest: utils.TransferManifest
+    :param local_path: where the log is stored locally
+    :param size: remote size of the log
+    :param mtime: remote modification time of the log
+    :return: None if up to date, otherwise the byte offset to resume from
+    """
+    name = os.path.basename(local_path)
+    entry = manifest.get(name)
+    unchanged = (entry is not None and
+                 entry['size'] == size and entry['mtime'] == mtime)
+    part_path = local_path + PART_SUFFIX
+
+    if os.path.exists(local_path):
+        if entry is None and os.path.getsize(local_path) == size:
+            # Fetched before the manifest was kept
+            manifest.update(name, None, size, mtime, True)
+            entry, unchanged = manifest.get(name), True
+        if unchanged and entry['complete']:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            return None
+
+    if unchanged and os.path.exists(part_path):
+        offset = os.path.getsize(part_path)
+        if offset <= size:
+            return offset
+
+    if os.path.exists(part_path):
+        os.remove(part_path)
+    return 0
+
+
+def connect_log_host(args):
+    """
+    Open a connection to a weblog storage location and find the logs
+    which are missing, incomplete, or changed since they were fetched
+
+    :param args: (log_loc, dmzinfo, outdir, begin, stop, manifest, clients),
+        the connection is added to clients as soon as it is open, so the
+        caller can close it even if listing this or another host fails
+    :type args: tuple
+    :return: connection, list of (remote path, local path, size, mtime, offset)
+    """
+    log_loc, dmzinfo, outdir, begin, stop, manifest, clients = args
+    host, remote_dir = log_loc.split(':')
+    logger.warning('*** Connect: {}@{}'.format(dmzinfo['username'], host))
+    client = utils.RemoteConnection(host, user=dmzinfo['username'],
+                                    password=dmzinfo['password'])
+    clients.append(client)
+    attrs = client.list_remote_attrs(remote_dir=remote_dir,
+                                     prefix=LOG_FILENAME)
+    files = utils.subset_by_date(sorted(attrs), begin, stop, LOG_FILE_TIMESTAMP)
+
+    transfers = []
+    for remote_path in files:
+        filename = ("{host}_{fname}"
+                    .format(host=host, fname=os.path.basename(remote_path)))
+        local_path = os.path.join(outdir, filename)
+        size, mtime = attrs[remote_path]
+        offset = plan_transfer(manifest, local_path, size, mtime)
+        if offset is not None:
+            transfers.append((remote_path, local_path, size, mtime, offset))
+
+    return client, transfers
+
+
+def download_log(args):
+    """
+    Download a single log, retrying on failure
+
+    The log is written to <local_path>.part and only renamed into place
+    once it matches the remote size, so a cut off transfer is resumed on
+    the next attempt (or run) and never mistaken for a complete log
+
+    :param args: (client, remote_path, local_path, size, mtime, manifest, retries)
+    :type args: tuple
+    :return: bytes transferred, seconds taken
+    """
+    client, remote_path, local_path, size, mtime, manifest, retries = args
+    name = os.path.basename(local_path)
+    remote = '{}:{}'.format(client.host, remote_path)
+    part_path = local_path + PART_SUFFIX
+    transferred = 0
+    start = time.time()
+
+    manifest.update(name, remote, size, mtime, False)
+    for attempt in range(1, retries + 1):
+        try:
+            transferred += client.resume_remote_file(remote_path=remote_path,
+                                                     local_path=part_path)
+            if os.path.getsize(part_path) != size:
+                os.remove(part_path)
+                raise IOError('Size mismatch for {}, expected {} bytes'
+                              .format(remote, size))
+            os.rename(part_path, local_path)
+            manifest.update(name, remote, size, mtime, True)
+            return transferred, time.time() - start
+        except Exception as e:
+            if attempt == retries:
+                raise
+            logger.warning('*** Retry ({}/{}) {}: {}'
+                           .format(attempt, retries, remote, e))
+            time.sleep(FETCH_BACKOFF * attempt)
+
+
+def fetch_web_logs(dbconfig, env, outdir, begin, stop, threads=FETCH_THREADS,
+                   retries=FETCH_RETRIES):
     """
     Connect to weblog storage location and move weblogs locally
 
+    Hosts are connected to, and files downloaded, concurrently.  Each host
+    gets a single SSH connection which is reused for all of its files.
+    Transfers are tracked in a manifest in outdir, only logs which are new,
+    partially transferred or changed remotely (size/mtime) are fetched.
+
     :param dbconfig: database connection info (host, port, username, password)
     :param env: dev/tst/ops (to get hostname of the external download servers)
     :param outdir: location to save log files
     :param begin: timestamp to begin searching the logs
     :param stop: timestamp to stop searching the logs
+    :param threads: maximum number of simultaneous transfers
+    :param retries: attempts made for each file before giving up
     :return: None
     """
     if not os.path.exists(outdir):
         os.makedirs(outdir)
 
+    manifest = utils.TransferManifest(os.path.join(outdir, FETCH_MANIFEST))
     dmzinfo = utils.query_connection_info(dbconfig, env)
-    for log_loc in dmzinfo['log_locs']:
-        host, remote_dir = log_loc.split(':')
-        logger.warning('*** Connect: {}@{}'.format(dmzinfo['username'], host))
-        client = utils.RemoteConnection(host, user=dmzinfo['username'],
-                                        password=dmzinfo['password'])
-        files = client.list_remote_files(remote_dir=remote_dir,
-                                         prefix=LOG_FILENAME)
-        files = utils.subset_by_date(files, begin, stop, LOG_FILE_TIMESTAMP)
-        for remote_path in files:
-            filename = ("{host}_{fname}"
-                        .format(host=host, fname=os.path.basename(remote_path)))
-            local_path = os.path.join(outdir, filename)
-            if not os.path.exists(local_path):
-                logger.warning('*** Download: {} -> {}'.format(remote_path, local_path))
-                client.download_remote_file(remote_path=remote_path,
-                                            local_path=local_path)
-
-
-def process_monthly_metrics(cfg, env, local_dir, begin, stop, sensors):
+    log_locs = dmzinfo['log_locs']
+    pool = ThreadPool(processes=max(1, min(threads, len(log_locs))))
+    clients = []
+    start = time.time()
+    try:
+        jobs = []
+        hosts = pool.map(connect_log_host,
+                         [(loc, dmzinfo, outdir, begin, stop, manifest, clients)
+                          for loc in log_locs])
+        for client, transfers in hosts:
+            jobs.extend((client, remote_path, local_path, size, mtime, manifest, retries)
+                        for remote_path, local_path, size, mtime, _ in transfers)
+            resumed = [t for t in transfers if t[-1]]
+            if resumed:
+                logger.warning('*** Resuming {} partial logs from {}'
+                               .format(len(resumed), client.host))
+        pool.close()
+        pool.join()
+
+        total_bytes = 0
+        if jobs:
+            pool = ThreadPool(processes=max(1, min(threads, len(jobs))))
+            for i, (nbytes, seconds) in enumerate(pool.imap(download_log, jobs), 1):
+                client, remote_path, local_path = jobs[i - 1][:3]
+                total_bytes += nbytes
+                logger.warning('*** Download [{}/{}]: {}:{} -> {} ({:.1f} MB in {:.1f}s)'
+                               .format(i, len(jobs), client.host, remote_path, local_path,
+                                       nbytes / 1048576.0, seconds))
+            pool.close()
+            pool.join()
+    finally:
+        pool.terminate()
+        for client in clients:
+            client.close()
+
+    profiling.count('logs_fetched', len(jobs))
+    profiling.count('bytes_fetched', total_bytes)
+    elapsed = time.time() - start
+    logger.warning('*** Fetched {} logs from {} hosts, {:.1f} MB in {:.1f}s ({:.2f} MB/s)'
+                   .format(len(jobs), len(log_locs), total_bytes / 1048576.0, elapsed,
+                           total_bytes / 1048576.0 / max(elapsed, 1e-6)))
+
+
+def process_monthly_metrics(cfg, env, local_dir, begin, stop, sensors,
+                            workers=1, use_cache=True, reader='auto',
+                            fetch_threads=FETCH_THREADS, cross_check=False,
+                            engine='logs', cache_days=CACHE_MAX_AGE_DAYS,
+                            timings_dir=TIMINGS_DIR):
     """
     Put together metrics for the previous month then
     email the results out
@@ -788,40 +1299,81 @@ def process_monthly_metrics(cfg, env, local_dir, begin, stop, sensors):
     :type stop: datetime.date
     :param sensors: which landsat/modis sensors to process (['tm4', 'etm7',...])
     :type sensors: tuple
+    :param workers: number of processes to parse the log files with
+    :type workers: int
+    :param use_cache: reuse the parse results of previous runs
+    :type use_cache: bool
+    :param reader: how to decompress the logs (weblogs.READERS)
+    :type reader: str
+    :param fetch_threads: maximum number of simultaneous log transfers
+    :type fetch_threads: int
+    :param cross_check: also tally the ordered products in python and compare
+    :type cross_check: bool
+    :param engine: how to count the downloads, 'logs', 'records' or 'pandas'
+    :type engine: str
+    :param cache_days: age after which the parse caches are removed
+    :type cache_days: int
+    :param timings_dir: where the run timings are kept
+    :type timings_dir: str
     """
-    fetch_web_logs(cfg, env, local_dir, begin, stop)
-
-    log_glob = os.path.join(local_dir, '*' + LOG_FILENAME + '*access_log*.gz')
-    infodict, order_paths = calc_dlinfo(log_glob, begin, stop, sensors)
-    infodict['title'] = ('On-demand - Total Download Info\n Sensors:{}'
-                         .format(','.join(sensors)))
-    msg = download_boiler(infodict)
-
-    # Downloads by Product
-    orders_scenes = extract_orderid(order_paths)
-
-    if len(orders_scenes):
-        prod_opts = db_dl_prodinfo(cfg, orders_scenes)
-        infodict = tally_product_dls(orders_scenes, prod_opts)
+    profiling.reset()
+
+    # The configuration lookups of the fetch and the report queries share
+    # the connections of one pool
+    with dbconnect.connection_pool(**cfg):
+        with profiling.timer('fetch'):
+            fetch_web_logs(cfg, env, local_dir, begin, stop, fetch_threads)
+            weblogs.evict_cache(local_dir, cache_days)
+
+        # No connection may be inherited by the parse workers
+        dbconnect.refresh_pool(**cfg)
+
+        log_glob = os.path.join(local_dir, '*' + LOG_FILENAME + '*access_log*.gz')
+        with profiling.timer('parse'):
+            infodict, order_paths = calc_dlinfo(log_glob, begin, stop, sensors,
+                                                workers, use_cache, reader, engine)
+        infodict['title'] = ('On-demand - Total Download Info\n Sensors:{}'
+                             .format(','.join(sensors)))
+        msg = download_boiler(infodict)
+        if 'by_sensor' in infodict:
+            msg += download_breakdown_boiler(infodict)
+
+        # Downloads by Product
+        orders_scenes = extract_orderid(order_paths)
+
+        if len(orders_scenes):
+            with profiling.timer('db_dl_prodinfo'):
+                prod_opts = db_dl_prodinfo(cfg, orders_scenes)
+            with profiling.timer('tally_product_dls'):
+                infodict = tally_product_dls(orders_scenes, prod_opts)
+            msg += prod_boiler(infodict)
+
+        # On-Demand users and orders placed information
+        with profiling.timer('db_ondemand_stats'):
+            ondemand = db_ondemand_stats(begin, stop, sensors, cfg)
+        for source in ORDER_SOURCES:
+            infodict = ondemand[source]
+            infodict['who'] = source.upper()
+            msg += ondemand_boiler(infodict)
+
+        # Orders by Product
+        with profiling.timer('db_prodinfo'):
+            infodict = db_prodinfo(cfg, begin, stop, sensors, cross_check)
         msg += prod_boiler(infodict)
 
-    # On-Demand users and orders placed information
-    for source in ORDER_SOURCES:
-        infodict = db_orderstats(source, begin, stop, sensors, cfg)
-        infodict.update(db_scenestats(source, begin, stop, sensors, cfg))
-        infodict['tot_unique'] = db_uniquestats(source, begin, stop, sensors, cfg)
-        infodict['who'] = source.upper()
-        msg += ondemand_boiler(infodict)
+        # Top 10 users by scenes ordered
+        with profiling.timer('db_top10stats'):
+            info = db_top10stats(begin, stop, sensors, cfg)
+        if len(info) > 0:
+            msg += top_users_boiler(info)
 
-
-    # Orders by Product
-    infodict = db_prodinfo(cfg, begin, stop, sensors)
-    msg += prod_boiler(infodict)
-
-    # Top 10 users by scenes ordered
-    info = db_top10stats(begin, stop, sensors, cfg)
-    if len(info) > 0:
-        msg += top_users_boiler(info)
+    # Run timings, kept month to month to catch regressions
+    timings = profiling.summary()
+    if not os.path.exists(timings_dir):
+        os.makedirs(timings_dir)
+    timings_file = TIMINGS_FILE.format(sensors=sensor_label(sensors), begin=begin, stop=stop)
+    profiling.write_summary(os.path.join(timings_dir, timings_file), timings)
+    msg += timing_boiler(timings)
 
     print(msg)
     return msg
@@ -834,65 +1386,83 @@ def run():
                 'conf_file': utils.CONF_FILE,
                 'dir': os.path.join(os.path.expanduser('~'), 'temp-logs'),
                 'sensors': 'ALL',
-                'plotting': False}
+                'plotting': False,
+                'workers': 1,
+                'cache': True,
+                'reader': 'auto',
+                'fetch_threads': FETCH_THREADS,
+                'cross_check': False,
+                'engine': 'logs',
+                'cache_days': CACHE_MAX_AGE_DAYS,
+                'profile': False,
+                'timings_dir': TIMINGS_DIR}
 
     opts = arg_parser(defaults)
     cfg = utils.get_cfg(opts['conf_file'], section='config')
     if opts['sensors'] == 'ALL':
-        opts['sensors'] = [k for k in SENSOR_KEYS if k != 'invalid']
-    if opts['sensors'] == ['MODIS']:
-        opts['sensors'] = [k for k in SENSOR_KEYS if k.lower().startswith('m')]
-    if opts['sensors'] == ['VIIRS']:
-        opts['sensors'] = [k for k in SENSOR_KEYS if k.lower().startswith('v')]
-    if opts['sensors'] == ['LANDSAT']:
-        opts['sensors'] = [k for k in SENSOR_KEYS if k != 'invalid' and not k.lower().startswith('m')]
-
-    msg = ''
-    receive, sender, debug = get_addresses(cfg)
-    subject = EMAIL_SUBJECT.format(begin=opts['begin'], stop=opts['stop'])
-    # FIXME: adding cruft to the codebase... time constraints....
-    if not opts['plotting']:
-        try:
-            msg = process_monthly_metrics(cfg,
-                                          opts['environment'],
-                                          opts['dir'],
-                                          opts['begin'],
-                                          opts['stop'],
-                                          tuple(opts['sensors']))
+        opts['sensors'] = list(SENSOR_GROUPS['ALL'])
+    elif len(opts['sensors']) == 1 and opts['sensors'][0] in SENSOR_GROUPS:
+        opts['sensors'] = list(SENSOR_GROUPS[opts['sensors'][0]])
+
+    # Shared by the address lookups and the report, see process_monthly_metrics
+    with dbconnect.connection_pool(**cfg):
+        msg = ''
+        receive, sender, debug = get_addresses(cfg)
+        subject = EMAIL_SUBJECT.format(begin=opts['begin'], stop=opts['stop'])
+        # FIXME: adding cruft to the codebase... time constraints....
+        if not opts['plotting']:
+            try:
+                profile = os.path.join(opts['timings_dir'], PROFILE_FILE.format(
+                    sensors=sensor_label(opts['sensors']), begin=opts['begin'], stop=opts['stop']))
+                if opts['profile'] and not os.path.exists(opts['timings_dir']):
+                    os.makedirs(opts['timings_dir'])
+                with profiling.profile(profile, opts['profile']):
+                    msg = process_monthly_metrics(cfg,
+                                                  opts['environment'],
+                                                  opts['dir'],
+                                                  opts['begin'],
+                                                  opts['stop'],
+                                                  tuple(opts['sensors']),
+                                                  opts['workers'],
+                                                  opts['cache'],
+                                                  opts['reader'],
+                                                  opts['fetch_threads'],
+                                                  opts['cross_check'],
+                                                  opts['engine'],
+                                                  opts['cache_days'],
+                                                  opts['timings_dir'])
+
+            except Exception:
+                exc_msg = str(traceback.format_exc()) + '\n\n' + msg
+                utils.send_email(sender, debug, subject, exc_msg)
+                msg = ('There was an error with statistics processing.\n'
+                       'The following have been notified of the error: {0}.'
+                       .format(', '.join(debug)))
+                raise
+            finally:
+                utils.send_email(sender, receive, subject, msg)
 
-        except Exception:
-            exc_msg = str(traceback.format_exc()) + '\n\n' + msg
-            utils.send_email(sender, debug, subject, exc_msg)
-            msg = ('There was an error with statistics processing.\n'
-                   'The following have been notified of the error: {0}.'
-                   .format(', '.join(debug)))
-            raise
-        finally:
-            utils.send_email(sender, receive, subject, msg)
-
-    else:
-        # msg = '⚠ PLOTTING IS STILL UNDER DEVELOPMENT! ⚠'
-        files = []
-        try:
-            files.append(graphics.sensor_barchart(cfg, opts['begin'], opts['stop']))
-            files.append(graphics.pathrow_heatmap(cfg, opts['begin'],
-                                                  opts['stop'], 'ALL'))
-
-            info = db_top10stats(opts['begin'], opts['stop'],
-                                 tuple(opts['sensors']), cfg)
-            for i, (email, _) in zip(range(3), info):
-                files.append(graphics.pathrow_heatmap(cfg, opts['begin'],
-                                                      opts['stop'], email))
-
-        except Exception:
-            exc_msg = str(traceback.format_exc()) + '\n\n' + msg
-            utils.send_email(sender, debug, subject, exc_msg)
-            msg = ('There was an error with statistics processing.\n'
-                   'The following have been notified of the error: {0}.'
-                   .format(', '.join(debug)))
-            raise
-        finally:
-            utils.send_email(sender, receive, subject, msg, files)
+        else:
+            # msg = '⚠ PLOTTING IS STILL UNDER DEVELOPMENT! ⚠'
+            files = []
+            try:
+                files.append(graphics.sensor_barchart(cfg, opts['begin'], opts['stop']))
+
+                info = db_top10stats(opts['begin'], opts['stop'],
+                                     tuple(opts['sensors']), cfg)
+                users = ['ALL'] + [email for email, _ in info[:3]]
+                files.extend(graphics.pathrow_heatmaps(cfg, opts['begin'],
+                                                       opts['stop'], users))
+
+            except Exception:
+                exc_msg = str(traceback.format_exc()) + '\n\n' + msg
+                utils.send_email(sender, debug, subject, exc_msg)
+                msg = ('There was an error with statistics processing.\n'
+                       'The following have been notified of the error: {0}.'
+                       .format(', '.join(debug)))
+                raise
+            finally:
+                utils.send_email(sender, receive, subject, msg, files)
 
 
 if __name__ == '__main__':
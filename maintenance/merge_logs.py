@@ -5,36 +5,21 @@
     Author: Jake Brinkmann <jacob.brinkmann.ctr@usgs.gov>
     Date: 11/01/2017
 """
-import re
 import glob
 import datetime
 import argparse
 import traceback
 import os
-import gzip
 import urllib2
 import multiprocessing as mp
 
 import utils
+from weblogs import LogMatcher, open_log
 
 DATE_FMT = '%Y-%m-%d'
 LOG_FILENAME = 'edclpdsftp.cr.usgs.gov-' # Change to ssl-access-log
 LOG_FILE_TIMESTAMP = '%Y%m%d' + '.gz'
 
-REGEXES = [
-    (r'(?P<ip>.*?) - \[(?P<datetime>.*?)\] "(?P<method>.*?) (?P<resource>.*?) (?P<protocol>.*?)" '
-     r'(?P<status>\d+) (?P<len>\d+) (?P<range>.*?) (?P<size>\d+) \[(?P<reqtime>\d+\.\d+)\] "(?P<referrer>.*?)" '
-     r'"(?P<agent>.*?)"'),
-    (r'(?P<ip>.*?) (?P<logname>.*?) (?P<user>.*?) \[(?P<datetime>.*?)\] "(?P<method>.*?) (?P<resource>.*?) '
-     r'(?P<status>\d+)" (?P<size>\d+) (?P<referrer>\d+) "(?P<agent>.*?)" "(?P<extra>.*?)"'),
-    (r'(?P<ip>[0-9\.]*) .* \[(?P<datetime>.*)\] \"(?P<method>[A-Z]*) (?P<resource>.*) '
-     r'(?P<protocol>.*)\" (?P<status>\d+) (?P<size>\d+) "(?P<referrer>.*?)" "(?P<agent>.*)"'),
-    (r'(?P<ip>[0-9\.]*) .* \[(?P<datetime>.*)\] "(?P<method>[A-Z]*) (?P<resource>.*) (?P<protocol>.*)" '
-     r'(?P<status>\d+) (?P<len>\d+) (?P<range>.*) (?P<size>\d+) \[(?P<reqtime>\d+\.\d+)\] "(?P<referrer>.*)" '
-     r'"(?P<agent>.*)"')
-]
-REGEXES = [re.compile(r) for r in REGEXES]
-
 
 def arg_parser(defaults):
     """
@@ -90,23 +75,23 @@ def parse_dls(log_glob, start_date, end_date, resource_regex):
     order_paths = set()
     for log_file in files:
         print('* Parse: {}'.format(log_file))
-        with gzip.open(log_file) as log:
-            for line in log:
-                gr = filter_log_line(line, start_date, end_date)
-                if gr:
-                    if get_sensor_name(gr['resource']) not in sensors:
-                        # Difficult to say if statistics should be counted...
-                        # if not gr['resource'].endswith('statistics.tar.gz'):
-                        continue
-                    rparts = gr['resource'].split('/')
-                    if len(rparts) != 4:
-                        raise ValueError('Unexpected directory structure: %s'
-                                         % rparts)
-                    elif rparts[1] not in valid_orderids:
-                        continue
-                    infodict['tot_vol'] += int(gr['size'])
-                    infodict['tot_dl'] += 1
-                    order_paths.add(gr['resource'])
+        matcher = LogMatcher(start_date, end_date, strict=True)
+        for line in open_log(log_file):
+            gr = matcher.match(line)
+            if gr:
+                if get_sensor_name(gr['resource']) not in sensors:
+                    # Difficult to say if statistics should be counted...
+                    # if not gr['resource'].endswith('statistics.tar.gz'):
+                    continue
+                rparts = gr['resource'].split('/')
+                if len(rparts) != 4:
+                    raise ValueError('Unexpected directory structure: %s'
+                                     % rparts)
+                elif rparts[1] not in valid_orderids:
+                    continue
+                infodict['tot_vol'] += int(gr['size'])
+                infodict['tot_dl'] += 1
+                order_paths.add(gr['resource'])
 
     # Bytes to GB
     infodict['tot_vol'] /= bytes_in_a_gb
@@ -117,44 +102,14 @@ def parse_dls(log_glob, start_date, end_date, resource_regex):
 def filter_log_line(line, start_date, end_date):
     """
     Used to determine if a line in the log should be used for metrics
-    counting
-
-    Filters to make sure the line follows a regex
-    HTTP response is a 200
-    HTTP method is a GET
-    location is from /orders/
-    falls within the date range
+    counting, see weblogs.LogMatcher.match
 
     :param line: incoming line from the log
     :param start_date: inclusive start date
     :param end_date: inclusive end date
     :return: regex groups returned from re.match
     """
-    # Leaving the old nginx log output style for previous months
-
-    if ('tar.gz' in line) and ('GET' in line):
-        for regex in regexs:
-            res = re.match(regex, line)
-            if res:
-                break
-        if res:
-            gr = res.groupdict()
-            ts, tz = gr['datetime'].split()
-            dt = datetime.datetime.strptime(ts, r'%d/%b/%Y:%H:%M:%S').date()
-
-            if ((gr['status'] in ['200', '206']) and
-                    gr['method'] == 'GET' and
-                    '.tar.gz' in gr['resource'] and
-                    '/orders/' in gr['resource'] and
-                    start_date <= dt <= end_date):
-
-                return gr
-            else:
-                return False
-        else:
-            raise ValueError('! Unable to parse download line: \n\t{}'.format(line))
-    else:
-        return False
+    return LogMatcher(start_date, end_date, strict=True).match(line)
 
 
 def date_range(offset=0):
@@ -207,16 +162,19 @@ def fetch_web_logs(dbconfig, env, outdir, begin, stop):
         host, remote_dir = log_loc.split(':')
         client = utils.RemoteConnection(host, user=dmzinfo['username'],
                                         password=dmzinfo['password'])
-        files = client.list_remote_files(remote_dir=remote_dir,
-                                         prefix=LOG_FILENAME)
-        files = utils.subset_by_date(files, begin, stop, LOG_FILE_TIMESTAMP)
-        for remote_path in files:
-            filename = ("{host}_{fname}"
-                        .format(host=host, fname=os.path.basename(remote_path)))
-            local_path = os.path.join(outdir, filename)
-            if not os.path.exists(local_path):
-                client.download_remote_file(remote_path=remote_path,
-                                            local_path=local_path)
+        try:
+            files = client.list_remote_files(remote_dir=remote_dir,
+                                             prefix=LOG_FILENAME)
+            files = utils.subset_by_date(files, begin, stop, LOG_FILE_TIMESTAMP)
+            for remote_path in files:
+                filename = ("{host}_{fname}"
+                            .format(host=host, fname=os.path.basename(remote_path)))
+                local_path = os.path.join(outdir, filename)
+                if not os.path.exists(local_path):
+                    client.resume_remote_file(remote_path=remote_path,
+                                              local_path=local_path)
+        finally:
+            client.close()
 
 
 def process_monthly_metrics(cfg, env, local_dir, begin, stop, sensors):
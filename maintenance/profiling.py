@@ -0,0 +1,146 @@
+"""Stage timers, counters and optional profiling for the report runs"""
+
+import os
+import json
+import time
+import pstats
+import logging
+import resource
+import cProfile
+import datetime
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+logger = logging.getLogger(__name__)
+
+# Lines of the profile listing which are logged
+PROFILE_TOP = 30
+
+# Recorded for the current run, in the order first seen
+_stages = OrderedDict()
+_counters = OrderedDict()
+_lock = threading.Lock()
+_started = [datetime.datetime.now()]
+
+
+def reset():
+    """
+    Forget everything recorded, e.g. before starting a new run
+    """
+    with _lock:
+        _stages.clear()
+        _counters.clear()
+        _started[0] = datetime.datetime.now()
+
+
+def cpu_seconds():
+    """
+    :return: user + system time of this process and its finished children
+    """
+    t = os.times()
+    return t[0] + t[1] + t[2] + t[3]
+
+
+def peak_rss_mb():
+    """
+    :return: peak resident memory of this process (ru_maxrss is KB on Linux)
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+@contextmanager
+def timer(name):
+    """
+    Time a stage of the run, repeated stages of the same name add up
+
+    :param name: name of the stage
+    :type name: str
+    """
+    start, cpu = time.time(), cpu_seconds()
+    try:
+        yield
+    finally:
+        elapsed, cpu = time.time() - start, cpu_seconds() - cpu
+        with _lock:
+            stage = _stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'cpu_seconds': 0.0})
+            stage['calls'] += 1
+            stage['seconds'] += elapsed
+            stage['cpu_seconds'] += cpu
+            stage['peak_rss_mb'] = peak_rss_mb()
+
+
+def count(name, value=1):
+    """
+    Add to a counter of the run (lines read, rows fetched, ...)
+
+    :param name: name of the counter
+    :type name: str
+    :param value: amount to add
+    """
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def summary():
+    """
+    :return: dict of everything recorded so far, ready for json
+    """
+    with _lock:
+        stages = OrderedDict((k, OrderedDict((f, round(v, 3) if isinstance(v, float) else v)
+                                             for f, v in sorted(s.items())))
+                             for k, s in _stages.items())
+        return OrderedDict([('started', _started[0].isoformat()),
+                            ('seconds', round((datetime.datetime.now() -
+                                               _started[0]).total_seconds(), 3)),
+                            ('peak_rss_mb', round(peak_rss_mb(), 1)),
+                            ('stages', stages),
+                            ('counters', OrderedDict(_counters))])
+
+
+def write_summary(path, info=None):
+    """
+    Write the run summary as JSON
+
+    :param path: where to write it
+    :param info: summary to write, defaults to the current one
+    """
+    info = info if info is not None else summary()
+    with open(path, 'w') as fid:
+        json.dump(info, fid, indent=2)
+    logger.info('* Timings written to {}'.format(path))
+
+
+@contextmanager
+def profile(path, enabled=True):
+    """
+    Run the enclosed code under cProfile, the stats are dumped to
+    <path>.prof and the most expensive calls logged
+
+    :param path: prefix of the file written
+    :type path: str
+    :param enabled: when False nothing is profiled
+    :type enabled: bool
+    """
+    if not enabled:
+        yield None
+        return
+
+    prof = cProfile.Profile()
+    prof.enable()
+    try:
+        yield prof
+    finally:
+        prof.disable()
+        prof.dump_stats(path + '.prof')
+        out = StringIO()
+        pstats.Stats(prof, stream=out).sort_stats('cumulative').print_stats(PROFILE_TOP)
+        for line in out.getvalue().splitlines():
+            if line.strip():
+                logger.info(line)
+        logger.info('* Profile written to {}.prof'.format(path))
@@ -7,6 +7,8 @@ import ConfigParser
 import os
 import datetime
 import base64
+import json
+import threading
 
 import paramiko
 from plumbum.machines.paramiko_machine import ParamikoMachine
@@ -146,6 +148,39 @@ class RemoteConnection():
         self.host, self.user, self.port = host, user, port
         self.remote = ParamikoMachine(self.host, user=self.user, password=password, port=self.port,
                                       missing_host_policy=paramiko.AutoAddPolicy())
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._sftps = []
+
+    @property
+    def sftp(self):
+        """
+        SFTP session of the calling thread
+
+        paramiko SFTP clients can not be shared between threads, so each
+        thread gets its own channel, all over the one SSH transport
+        """
+        sftp = getattr(self._local, 'sftp', None)
+        if sftp is None:
+            with self._lock:
+                if not self._sftps:
+                    sftp = self.remote.sftp
+                else:
+                    transport = self._sftps[0].get_channel().get_transport()
+                    sftp = paramiko.SFTPClient.from_transport(transport)
+                self._sftps.append(sftp)
+            self._local.sftp = sftp
+        return sftp
+
+    def close(self):
+        """
+        Close all SFTP sessions and the connection to the remote host
+        """
+        with self._lock:
+            for sftp in self._sftps[1:]:
+                sftp.close()
+            self._sftps = []
+        self.remote.close()
 
     def list_remote_files(self, remote_dir, prefix):
         """
@@ -164,14 +199,96 @@ class RemoteConnection():
         else:
             raise ValueError('No files found at {host}:{loc}'.format(host=self.host, loc=remote_dir))
 
-    def download_remote_file(self, remote_path, local_path):
+    def list_remote_attrs(self, remote_dir, prefix):
+        """
+        List the size and modification time of files in folder on a remote
+        host which start with a given prefix, in a single round trip
+
+        :param remote_dir: the absolute location of the folder to search
+        :param prefix: the beginning of all files names to find
+        :return: dict of remote full path: (size, mtime)
         """
-        Transfer a file from a remote host locally
+        attrs = self.sftp.listdir_attr(remote_dir)
+        files = {os.path.join(remote_dir, a.filename): (a.st_size, a.st_mtime)
+                 for a in attrs if a.filename.startswith(prefix)}
+
+        if len(files):
+            return files
+        else:
+            raise ValueError('No files found at {host}:{loc}'.format(host=self.host, loc=remote_dir))
+
+    def resume_remote_file(self, remote_path, local_path, chunk_size=1048576):
+        """
+        Transfer the rest of a file from a remote host, appending to
+        whatever part of it already exists locally
 
         :param remote_path: the absolute location of the file to grab (including host)
-        :param local_path: the local file to write to
+        :param local_path: the local (partial) file to append to
+        :param chunk_size: bytes to read per request
+        :return: number of bytes transferred
+        """
+        offset = os.path.getsize(local_path) if os.path.exists(local_path) else 0
+        transferred = 0
+
+        with self.sftp.open(remote_path, 'rb') as rfid:
+            rfid.seek(offset)
+            rfid.prefetch()
+            with open(local_path, 'ab') as lfid:
+                while True:
+                    data = rfid.read(chunk_size)
+                    if not data:
+                        break
+                    lfid.write(data)
+                    transferred += len(data)
+
+        return transferred
+
+
+class TransferManifest(object):
+    """
+    Record of the files fetched from remote hosts, kept as JSON next
+    to the downloads, so later runs can tell complete files from ones
+    which changed remotely or were only partially transferred
+    """
+    def __init__(self, path):
+        """
+        :param path: location of the manifest file
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self.entries = {}
+
+        if os.path.exists(path):
+            try:
+                with open(path) as fid:
+                    self.entries = json.load(fid)
+            except ValueError:
+                print('! Ignoring unreadable transfer manifest: {}'.format(path))
+
+    def get(self, name):
+        """
+        :param name: local file name
+        :return: dict of remote, size, mtime and complete, or None
+        """
+        return self.entries.get(name)
+
+    def update(self, name, remote, size, mtime, complete):
+        """
+        Record the state of a transfer and save the manifest
+
+        :param name: local file name
+        :param remote: remote location (host:path)
+        :param size: remote size in bytes
+        :param mtime: remote modification time
+        :param complete: whether the local copy is complete
         """
-        self.remote.download(remote_path, local_path)
+        with self._lock:
+            self.entries[name] = {'remote': remote, 'size': size,
+                                  'mtime': mtime, 'complete': complete}
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as fid:
+                json.dump(self.entries, fid, indent=1, sort_keys=True)
+            os.rename(tmp_path, self.path)
 
 
 def subset_by_date(files, begin, stop, tsfrmt='%Y%m%d.gz'):
@@ -0,0 +1,640 @@
+"""Parsing helpers for the nginx access logs of the download servers"""
+
+import os
+import re
+import errno
+import gzip
+import time
+import zlib
+import struct
+import datetime
+import subprocess
+from distutils.spawn import find_executable
+
+import numpy as np
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+# Leaving the old nginx log output styles for previous months
+REGEXES = [
+    (r'(?P<ip>.*?) - \[(?P<datetime>.*?)\] "(?P<method>.*?) (?P<resource>.*?) (?P<protocol>.*?)" '
+     r'(?P<status>\d+) (?P<len>\d+) (?P<range>.*?) (?P<size>\d+) \[(?P<reqtime>\d+\.\d+)\] "(?P<referrer>.*?)" '
+     r'"(?P<agent>.*?)"'),
+    (r'(?P<ip>.*?) (?P<logname>.*?) (?P<user>.*?) \[(?P<datetime>.*?)\] "(?P<method>.*?) (?P<resource>.*?) '
+     r'(?P<status>\d+)" (?P<size>\d+) (?P<referrer>\d+) "(?P<agent>.*?)" "(?P<extra>.*?)"'),
+    (r'(?P<ip>[0-9\.]*) .* \[(?P<datetime>.*)\] \"(?P<method>[A-Z]*) (?P<resource>.*) '
+     r'(?P<protocol>.*)\" (?P<status>\d+) (?P<size>\d+) "(?P<referrer>.*?)" "(?P<agent>.*)"'),
+    (r'(?P<ip>[0-9\.]*) .* \[(?P<datetime>.*)\] "(?P<method>[A-Z]*) (?P<resource>.*) (?P<protocol>.*)" '
+     r'(?P<status>\d+) (?P<len>\d+) (?P<range>.*) (?P<size>\d+) \[(?P<reqtime>\d+\.\d+)\] "(?P<referrer>.*)" '
+     r'"(?P<agent>.*)"')
+]
+REGEXES = [re.compile(r) for r in REGEXES]
+
+LOG_DAY_FMT = '%d/%b/%Y'
+OK_STATUS = ('200', '206')
+
+# Decompression commands which can stream a log to stdout, in order of preference
+PIPE_READERS = (('pigz', ['pigz', '-dc']),
+                ('zcat', ['zcat']))
+READERS = ('auto', 'pigz', 'zcat', 'zlib', 'gzip')
+READ_CHUNK = 4 * 1024 * 1024
+
+# Per log file parse cache, stored next to the log as <log>.dlcache
+# Bump CACHE_VERSION whenever the summary layout or the filtering changes
+CACHE_VERSION = 1
+CACHE_SUFFIX = '.dlcache'
+
+# Columnar store of every accepted download line, next to the log as
+# <log>.records.npz.  Strings are dictionary encoded: <name> holds codes
+# into <name>_values.  Bump RECORDS_VERSION whenever the layout changes
+RECORDS_VERSION = 1
+RECORDS_SUFFIX = '.records.npz'
+RECORD_STRINGS = ('ip', 'resource', 'agent')
+
+# Either is first written to <cache>.<pid>.tmp, then renamed
+TMP_RE = re.compile(r'.*(?:{}|{})\.(?P<pid>\d+)\.tmp$'
+                    .format(re.escape(CACHE_SUFFIX), re.escape(RECORDS_SUFFIX)))
+
+
+class LogMatcher(object):
+    """
+    Filters and parses the download lines of an access log
+
+    The log format is found from the first download line seen, every
+    line after that costs a single compiled match.  Use one matcher
+    per log file (or call reset) since the format changed over time.
+
+    Unlike trying the patterns in order on each line, a line which fits
+    both the detected pattern and one earlier in REGEXES is parsed with
+    the detected one.  The patterns are only tried again in order when
+    a line no longer fits the detected one.
+    """
+    def __init__(self, start_date, end_date, regexes=None, strict=False):
+        """
+        :param start_date: inclusive start date
+        :type start_date: datetime.date
+        :param end_date: inclusive end date
+        :type end_date: datetime.date
+        :param regexes: compiled patterns to detect the format from,
+            in order of preference (defaults to REGEXES)
+        :param strict: raise on lines that do not follow any pattern,
+            instead of only reporting them
+        """
+        self.regexes = regexes or REGEXES
+        self.strict = strict
+        self.first_day = start_date.toordinal()
+        self.last_day = end_date.toordinal()
+        self.regex = None
+        self._days = {}
+
+    def reset(self):
+        """
+        Forget the detected log format, e.g. before starting a new file
+        """
+        self.regex = None
+
+    def detect(self, line):
+        """
+        Find the first pattern in order of preference which parses the line
+
+        :param line: download line from the log
+        :return: regex match or None
+        """
+        for regex in self.regexes:
+            res = regex.match(line)
+            if res:
+                self.regex = regex
+                return res
+
+    def day(self, timestamp):
+        """
+        Convert a log timestamp (04/Aug/2019:12:00:00 -0500) into
+        a proleptic Gregorian ordinal, parsing each distinct day only once
+
+        :param timestamp: datetime field of the log line
+        :return: int
+        """
+        key = timestamp[:11]
+        try:
+            return self._days[key]
+        except KeyError:
+            day = datetime.datetime.strptime(key, LOG_DAY_FMT).toordinal()
+            self._days[key] = day
+            return day
+
+    def match(self, line):
+        """
+        Used to determine if a line in the log should be used for metrics
+        counting
+
+        Filters to make sure the line follows the log format
+        HTTP response is a 200/206
+        HTTP method is a GET
+        location is from /orders/
+        falls within the date range
+
+        :param line: incoming line from the log
+        :return: regex groups of the line, or False
+        """
+        if ('tar.gz' not in line) or ('GET' not in line):
+            return False
+
+        res = None
+        if self.regex is not None:
+            res = self.regex.match(line)
+        if res is None:
+            res = self.detect(line)
+        if res is None:
+            if self.strict:
+                raise ValueError('! Unable to parse download line: \n\t{}'.format(line))
+            print('!'*50 + '\nUnable to parse download line: \n\t{}'.format(line))
+            return False
+
+        gr = res.groupdict()
+        if (gr['status'] in OK_STATUS and
+                gr['method'] == 'GET' and
+                '.tar.gz' in gr['resource'] and
+                '/orders/' in gr['resource'] and
+                self.first_day <= self.day(gr['datetime']) <= self.last_day):
+            return gr
+
+        return False
+
+
+def pipe_lines(log_file, command):
+    """
+    Stream the lines of a gzipped log through an external decompressor
+
+    :param log_file: path to the gzipped log
+    :param command: decompression command, taking the file as last argument
+    :return: generator of lines
+    """
+    proc = subprocess.Popen(command + [log_file], stdout=subprocess.PIPE,
+                            bufsize=READ_CHUNK)
+    finished = False
+    try:
+        for line in proc.stdout:
+            yield line
+        finished = True
+    finally:
+        proc.stdout.close()
+        if not finished and proc.poll() is None:
+            # Stopped reading early
+            proc.kill()
+        proc.wait()
+
+    if proc.returncode != 0:
+        raise IOError('{} exited with {} on {}'
+                      .format(command[0], proc.returncode, log_file))
+
+
+def zlib_lines(log_file, chunk_size=READ_CHUNK):
+    """
+    Stream the lines of a gzipped log by decompressing large blocks
+    at a time and splitting them on newlines
+
+    Handles multi-member files (e.g. appended by logrotate), and checks
+    the size stored in the gzip trailer to catch truncated downloads.
+    An empty file (an interrupted transfer) has no lines
+
+    :param log_file: path to the gzipped log
+    :param chunk_size: number of compressed bytes to read at once
+    :return: generator of lines
+    """
+    # 16 + MAX_WBITS: expect a gzip header and trailer
+    decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    member_size = 0
+    tail = ''
+
+    with open(log_file, 'rb') as fid:
+        while True:
+            chunk = fid.read(chunk_size)
+            if not chunk:
+                break
+
+            while chunk:
+                data = decomp.decompress(chunk)
+                member_size += len(data)
+                chunk = decomp.unused_data
+                if chunk:
+                    # Start of the next gzip member
+                    decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    member_size = 0
+
+                data = tail + data
+                end = data.rfind('\n') + 1
+                tail = data[end:]
+                if end:
+                    for line in data[:end - 1].split('\n'):
+                        yield line + '\n'
+
+        size = fid.tell()
+        if size == 0:
+            # Nothing was transferred, no lines rather than a truncated file
+            return
+        if size < 4:
+            raise IOError('Truncated gzip file: {}'.format(log_file))
+        fid.seek(-4, os.SEEK_END)
+        isize, = struct.unpack('<I', fid.read(4))
+
+    if isize != member_size % 2**32:
+        raise IOError('Truncated gzip file: {}'.format(log_file))
+
+    if tail:
+        yield tail
+
+
+def gzip_lines(log_file):
+    """
+    Stream the lines of a gzipped log with the gzip module
+
+    :param log_file: path to the gzipped log
+    :return: generator of lines
+    """
+    with gzip.open(log_file) as log:
+        for line in log:
+            yield line
+
+
+def find_reader(reader='auto'):
+    """
+    Pick the fastest available way to read the logs
+
+    :param reader: one of READERS, 'auto' prefers a pigz/zcat pipe,
+        then the zlib block reader
+    :return: reader name
+    """
+    if reader not in READERS:
+        raise ValueError('Unknown log reader {}, expected one of {}'
+                         .format(reader, READERS))
+
+    if reader == 'auto':
+        for name, command in PIPE_READERS:
+            if find_executable(command[0]):
+                return name
+        return 'zlib'
+
+    commands = dict(PIPE_READERS)
+    if reader in commands and not find_executable(commands[reader][0]):
+        print('! {} not found, reading logs with gzip'.format(reader))
+        return 'gzip'
+
+    return reader
+
+
+def open_log(log_file, reader='auto'):
+    """
+    Iterate over the lines of a gzipped log
+
+    An empty file (an interrupted transfer) has no lines, whichever
+    the reader
+
+    :param log_file: path to the gzipped log
+    :param reader: one of READERS
+    :return: generator of lines
+    """
+    if os.path.getsize(log_file) == 0:
+        return iter([])
+
+    reader = find_reader(reader)
+    commands = dict(PIPE_READERS)
+
+    if reader in commands:
+        return pipe_lines(log_file, commands[reader])
+    elif reader == 'zlib':
+        return zlib_lines(log_file)
+    else:
+        return gzip_lines(log_file)
+
+
+def summarize_log(log_file, reader='auto', records=False, stats=None):
+    """
+    Tally every download in a log file, for all days and products
+
+    Nothing is filtered on date range or sensor, so the summary can be
+    reused for any report window which covers this file
+
+    :param log_file: path to the gzipped access log
+    :param reader: how to decompress the log, one of READERS
+    :param records: also store every download line in the columnar
+        record file of the log (see save_records)
+    :param stats: dict to add the lines read and the download lines
+        matched to (lines_read, lines_matched)
+    :return: {day ordinal: {resource: [downloads, bytes]}}
+    """
+    matcher = LogMatcher(datetime.date.min, datetime.date.max)
+    columns = RecordColumns() if records else None
+    summary = {}
+    lines = 0
+
+    for lines, line in enumerate(open_log(log_file, reader), 1):
+        gr = matcher.match(line)
+        if gr:
+            day = matcher.day(gr['datetime'])
+            resources = summary.setdefault(day, {})
+            counts = resources.setdefault(gr['resource'], [0, 0])
+            counts[0] += 1
+            counts[1] += int(gr['size'])
+            if columns is not None:
+                columns.append(day, gr)
+
+    if columns is not None:
+        save_records(log_file, columns.arrays())
+
+    if stats is not None:
+        matched = sum(counts[0] for resources in summary.values()
+                      for counts in resources.values())
+        stats['lines_read'] = stats.get('lines_read', 0) + lines
+        stats['lines_matched'] = stats.get('lines_matched', 0) + matched
+
+    return summary
+
+
+class RecordColumns(object):
+    """
+    Collects the fields of parsed download lines column by column,
+    dictionary encoding the repetitive strings as they come in
+    """
+    def __init__(self):
+        self.day, self.second, self.status, self.size = [], [], [], []
+        self.codes = {name: [] for name in RECORD_STRINGS}
+        self.values = {name: {} for name in RECORD_STRINGS}
+
+    def append(self, day, gr):
+        """
+        :param day: ordinal of the (log local) day of the line
+        :param gr: regex groups of the line, from LogMatcher.match
+        """
+        # 04/Aug/2019:12:00:00 -0500
+        ts = gr['datetime']
+        self.day.append(day)
+        self.second.append(int(ts[12:14]) * 3600 + int(ts[15:17]) * 60 + int(ts[18:20]))
+        self.status.append(int(gr['status']))
+        self.size.append(int(gr['size']))
+        for name in RECORD_STRINGS:
+            values = self.values[name]
+            self.codes[name].append(values.setdefault(gr[name], len(values)))
+
+    def arrays(self):
+        """
+        :return: dict of column name: numpy array
+        """
+        arrays = {'day': np.array(self.day, dtype=np.int32),
+                  'second': np.array(self.second, dtype=np.int32),
+                  'status': np.array(self.status, dtype=np.int16),
+                  'size': np.array(self.size, dtype=np.int64)}
+        for name in RECORD_STRINGS:
+            table = sorted(self.values[name], key=self.values[name].get)
+            arrays[name] = np.array(self.codes[name], dtype=np.uint32)
+            arrays[name + '_values'] = np.array(table, dtype=str)
+        return arrays
+
+
+def cache_path(log_file):
+    """
+    Location of the parse cache for a log file
+
+    :param log_file: path to the log
+    :return: str
+    """
+    return log_file + CACHE_SUFFIX
+
+
+def cache_key(log_file):
+    """
+    Identify the contents of a log file without reading it
+    Rotated logs are never rewritten, so name, size and mtime suffice
+
+    :param log_file: path to the log
+    :return: (name, size, mtime)
+    """
+    stat = os.stat(log_file)
+    return os.path.basename(log_file), stat.st_size, int(stat.st_mtime)
+
+
+def load_summary(log_file):
+    """
+    Retrieve the cached summary of a log file
+
+    :param log_file: path to the log
+    :return: summary as from summarize_log, None if missing or out of date
+    """
+    path = cache_path(log_file)
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with open(path, 'rb') as fid:
+            cached = pickle.load(fid)
+    except Exception:
+        return None
+
+    if (not isinstance(cached, dict) or
+            cached.get('version') != CACHE_VERSION or
+            cached.get('key') != cache_key(log_file)):
+        return None
+
+    return cached['summary']
+
+
+def save_summary(log_file, summary):
+    """
+    Cache the summary of a log file next to it
+
+    Written to a temporary file first, so an interrupted run
+    never leaves a truncated cache behind
+
+    :param log_file: path to the log
+    :param summary: as from summarize_log
+    """
+    path = cache_path(log_file)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    cached = {'version': CACHE_VERSION,
+              'key': cache_key(log_file),
+              'summary': summary}
+
+    try:
+        with open(tmp_path, 'wb') as fid:
+            pickle.dump(cached, fid, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def records_path(log_file):
+    """
+    Location of the columnar download records of a log file
+
+    :param log_file: path to the log
+    :return: str
+    """
+    return log_file + RECORDS_SUFFIX
+
+
+def save_records(log_file, arrays):
+    """
+    Store the download records of a log file next to it
+
+    :param log_file: path to the log
+    :param arrays: columns, as from RecordColumns.arrays
+    """
+    path = records_path(log_file)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    name, size, mtime = cache_key(log_file)
+    arrays = dict(arrays, meta=np.array([RECORDS_VERSION, size, mtime], dtype=np.int64))
+
+    try:
+        with open(tmp_path, 'wb') as fid:
+            np.savez_compressed(fid, **arrays)
+        os.rename(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def load_records(log_file):
+    """
+    Retrieve the download records of a log file
+
+    :param log_file: path to the log
+    :return: dict of column name: numpy array, None if missing or out of date
+    """
+    path = records_path(log_file)
+    if not os.path.exists(path):
+        return None
+
+    name, size, mtime = cache_key(log_file)
+    try:
+        with np.load(path) as npz:
+            arrays = {k: npz[k] for k in npz.files}
+    except Exception:
+        return None
+
+    if list(arrays.get('meta', [])) != [RECORDS_VERSION, size, mtime]:
+        return None
+
+    del arrays['meta']
+    return arrays
+
+
+def records_current(log_file):
+    """
+    Whether the saved download records of a log file are up to date,
+    without reading the columns themselves
+
+    :param log_file: path to the log
+    :return: bool
+    """
+    path = records_path(log_file)
+    if not os.path.exists(path):
+        return False
+
+    try:
+        with np.load(path) as npz:
+            meta = list(npz['meta'])
+    except Exception:
+        return False
+
+    name, size, mtime = cache_key(log_file)
+    return meta == [RECORDS_VERSION, size, mtime]
+
+
+def read_records(log_files, start_date, end_date):
+    """
+    Combine the download records of several log files, keeping only
+    those within the date range.  The string dictionaries of the files
+    are merged, so codes are consistent across the result.
+
+    :param log_files: paths to the logs, which must have their records saved
+    :param start_date: inclusive start date
+    :type start_date: datetime.date
+    :param end_date: inclusive end date
+    :type end_date: datetime.date
+    :return: dict of column name: numpy array, as from load_records
+    """
+    first_day, last_day = start_date.toordinal(), end_date.toordinal()
+    tables = {name: {} for name in RECORD_STRINGS}
+    parts = []
+
+    for log_file in log_files:
+        arrays = load_records(log_file)
+        if arrays is None:
+            raise IOError('No download records saved for {}'.format(log_file))
+
+        keep = (arrays['day'] >= first_day) & (arrays['day'] <= last_day)
+        part = {k: arrays[k][keep] for k in ('day', 'second', 'status', 'size')}
+        for name in RECORD_STRINGS:
+            table = tables[name]
+            remap = np.array([table.setdefault(v, len(table))
+                              for v in arrays[name + '_values']], dtype=np.uint32)
+            part[name] = remap[arrays[name][keep]] if len(remap) else arrays[name][keep]
+        parts.append(part)
+
+    records = {}
+    for column, dtype in (('day', np.int32), ('second', np.int32),
+                          ('status', np.int16), ('size', np.int64)):
+        records[column] = np.concatenate([p[column] for p in parts] or
+                                         [np.array([], dtype=dtype)])
+    for name in RECORD_STRINGS:
+        records[name] = np.concatenate([p[name] for p in parts] or
+                                       [np.array([], dtype=np.uint32)])
+        records[name + '_values'] = np.array(sorted(tables[name], key=tables[name].get),
+                                             dtype=str)
+
+    return records
+
+
+def process_alive(pid):
+    """
+    :param pid: process id
+    :return: whether a process of that id is running on this host
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def evict_cache(directory, max_age_days=None):
+    """
+    Remove parse caches and download records whose log file is gone
+    or which were written more than max_age_days ago, and the temporary
+    files left by writers which were killed
+
+    :param directory: folder holding the logs
+    :param max_age_days: optional age limit for the caches
+    :return: list of the removed cache files
+    """
+    removed = []
+    if not os.path.isdir(directory):
+        return removed
+
+    now = time.time()
+    for fname in os.listdir(directory):
+        tmp = TMP_RE.match(fname)
+        if tmp and not process_alive(int(tmp.group('pid'))):
+            path = os.path.join(directory, fname)
+            os.remove(path)
+            removed.append(path)
+            continue
+
+        suffix = [x for x in (CACHE_SUFFIX, RECORDS_SUFFIX) if fname.endswith(x)]
+        if not suffix:
+            continue
+        path = os.path.join(directory, fname)
+        log_file = path[:-len(suffix[0])]
+
+        expired = (max_age_days is not None and
+                   now - os.path.getmtime(path) > max_age_days * 86400)
+        if expired or not os.path.exists(log_file):
+            os.remove(path)
+            removed.append(path)
+
+    return removed